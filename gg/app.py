@@ -33,6 +33,8 @@ GtkClutter.init([])
 from gi.repository import Gtk, Gdk
 from gi.repository import GdkPixbuf
 from gi.repository import Champlain, Pango
+from multiprocessing.pool import ThreadPool
+from multiprocessing import TimeoutError, cpu_count
 from os.path import join, basename, abspath
 from gettext import gettext as _
 from time import clock
@@ -45,19 +47,52 @@ from sys import argv
 from photos import Photograph
 from camera import known_cameras
 from common import points, photos
-from common import metadata, selected, modified
-from common import Struct, get_obj, gst, map_view
+from common import selected, modified, batch
+from common import Struct, get_obj, gst, map_view, dem
+from gpsmath import Coordinates
+from geocoder import geocoder
 from xmlfiles import clear_all_gpx, get_trackfile, known_trackfiles
 
 from drag import DragController
 from actor import ActorController
 from label import LabelController
-from search import SearchController
+from search import SearchController, searcher
 from navigation import NavigationController
 
 # Handy names for GtkListStore column numbers.
 PATH, SUMMARY, THUMB, TIMESTAMP = range(4)
 
+# How many photos to read from disk at once.
+LOAD_THREADS = cpu_count()
+
+# How long to wait for a photo to finish loading before redrawing, in seconds.
+LOAD_WAIT = 0.05
+
+def load_photo(filename):
+    """Read a photo from disk on a worker thread, see Photograph.load."""
+    try:
+        return Photograph(filename).load()
+    except IOError:
+        return None
+
+def batches(results, total):
+    """Group the results of ThreadPool.imap into lists of whatever is ready.
+    
+    Waits no more than LOAD_WAIT for each list, so some of them are empty,
+    which gives the caller a chance to keep the interface responsive.
+    """
+    done = 0
+    while done < total:
+        ready = []
+        try:
+            ready.append(results.next(LOAD_WAIT))
+            while True:
+                ready.append(results.next(0))
+        except (TimeoutError, StopIteration):
+            pass
+        done += len(ready)
+        yield ready
+
 
 class GottenGeography():
     """Provides a graphical interface to automagically geotag photos.
@@ -75,25 +110,48 @@ class GottenGeography():
         """Attempt to load all of the specified files."""
         self.progressbar.show()
         invalid, total = [], len(files)
-        for i, name in enumerate(files, 1):
-            self.redraw_interface(i / total, basename(name))
-            try:
-                try:            self.load_img_from_file(name)
-                except IOError: self.load_gpx_from_file(name)
-            except IOError:
-                invalid.append(basename(name))
+        stale = set()
+        
+        # Photos are read by a pool of worker threads, in the background, and
+        # handed back here in the order they were given, in batches of
+        # however many have finished since the interface was last redrawn.
+        pool = ThreadPool(LOAD_THREADS)
+        names = iter(files)
+        done = 0
+        try:
+            for ready in batches(pool.imap(load_photo, files), total):
+                for loaded in ready:
+                    name = names.next()
+                    done += 1
+                    try:
+                        try:
+                            if loaded is None:
+                                raise IOError
+                            photo = self.load_img_from_file(name, loaded)
+                            stale.add(photo.camera)
+                        except IOError: self.load_gpx_from_file(name)
+                    except IOError:
+                        invalid.append(basename(name))
+                self.redraw_interface(done / total,
+                                      basename(name) if done else None)
+        finally:
+            pool.close()
         if len(invalid) > 0:
             self.status_message(_('Could not open: ') + ', '.join(invalid))
         
         # Ensure camera has found correct timezone regardless of the order
-        # that the GPX/KML files were loaded in.
-        for camera in known_cameras.values():
-            camera.set_timezone()
+        # that the GPX/KML files were loaded in. Cameras that didn't get any
+        # new photos are left alone, because loading a track already
+        # re-tagged the photos within its time range, and finding a new
+        # timezone retimes the camera by itself, see Camera.found_handler.
+        with batch:
+            for camera in stale:
+                batch.retime(camera)
         self.progressbar.hide()
         self.labels.selection.emit('changed')
         map_view.emit('animation-completed')
     
-    def load_img_from_file(self, uri):
+    def load_img_from_file(self, uri, loaded=None):
         """Create or update a row in the ListStore.
         
         Checks if the file has already been loaded, and if not, creates a new
@@ -101,10 +159,14 @@ class GottenGeography():
         photo metadata as read from disk. Effectively, this is used both for
         loading new photos, and reverting old photos, discarding any changes.
         
-        Raises IOError if filename refers to a file that is not a photograph.
+        If the photo has already been read from disk by Photograph.load,
+        loaded is what that returned.
+        
+        Returns the Photograph, or raises IOError if filename refers to a
+        file that is not a photograph.
         """
         photo = photos.get(uri) or Photograph(uri)
-        photo.read()
+        photo.read(loaded)
         if uri not in photos:
             photo.label = self.labels.add(uri)
             photos[uri] = photo
@@ -114,6 +176,7 @@ class GottenGeography():
         if photo.camera.gst.get_string('timezone-method') == 'lookup':
             photo.calculate_timestamp()
         modified.discard(photo)
+        return photo
     
     def load_gpx_from_file(self, uri):
         """Parse GPX data, drawing each GPS track segment on the map."""
@@ -121,15 +184,16 @@ class GottenGeography():
         
         gpx = get_trackfile(uri)
         
-        self.status_message(_('%d points loaded in %.2fs.') %
-            (len(gpx.tracks), clock() - start_time), True)
+        message = _('%d points loaded in %.2fs.') % (
+            len(gpx.tracks), clock() - start_time)
+        if gpx.outliers > 0:
+            message += ' ' + _('%d impossible points were discarded.') % (
+                gpx.outliers)
+        self.status_message(message, True)
         
         if len(gpx.tracks) < 2:
             return
         
-        metadata.alpha = min(metadata.alpha, gpx.alpha)
-        metadata.omega = max(metadata.omega, gpx.omega)
-        
         map_view.emit('realize')
         map_view.set_zoom_level(map_view.get_max_zoom_level())
         bounds = Champlain.BoundingBox.new()
@@ -143,13 +207,15 @@ class GottenGeography():
     
     def apply_selected_photos(self, button):
         """Manually apply map center coordinates to all unpositioned photos."""
-        for photo in photos.values():
-            if photo.manual:
-                continue
-            photo.manual = True
-            photo.set_location(
-                map_view.get_property('latitude'),
-                map_view.get_property('longitude'))
+        lat = map_view.get_property('latitude')
+        lon = map_view.get_property('longitude')
+        ele = dem.elevation(lat, lon)
+        with batch:
+            for photo in photos.values():
+                if photo.manual:
+                    continue
+                photo.manual = True
+                photo.set_location(lat, lon, ele)
         self.labels.selection.emit('changed')
     
     def save_all_files(self, widget=None):
@@ -321,19 +387,22 @@ class GottenGeography():
         # This bit of magic will only show the apply button when there is
         # at least one photo loaded that is not manually positioned.
         # In effect, it allows you to manually drag & drop some photos,
-        # then batch-apply all the rest
-        btn_sense = lambda *x: button.set_sensitive(
-            [photo for photo in photos.values() if not photo.manual])
+        # then batch-apply all the rest. These listeners all ignore the
+        # individual row changes made while a LocationBatch is flushing.
+        btn_sense = lambda *x: batch.depth or button.set_sensitive(
+            any(not photo.manual for photo in photos.values()))
         self.liststore.connect('row-changed', btn_sense)
         self.liststore.connect('row-deleted', btn_sense)
         
         empty = get_obj('empty_photo_list')
-        empty_visible = lambda l, *x: empty.set_visible(l.get_iter_first() is None)
+        empty_visible = lambda l, *x: batch.depth or \
+            empty.set_visible(l.get_iter_first() is None)
         self.liststore.connect('row-changed', empty_visible)
         self.liststore.connect('row-deleted', empty_visible)
         
         toolbar = get_obj('photo_btn_bar')
-        bar_visible = lambda l, *x: toolbar.set_visible(l.get_iter_first() is not None)
+        bar_visible = lambda l, *x: batch.depth or \
+            toolbar.set_visible(l.get_iter_first() is not None)
         self.liststore.connect('row-changed', bar_visible)
         self.liststore.connect('row-deleted', bar_visible)
         
@@ -403,5 +472,8 @@ class GottenGeography():
             self.open_files([abspath(f) for f in argv[1:]])
             anim=False
         self.actors.animate_in(anim)
+        geocoder.threaded = True
+        searcher.threaded = True
         Gtk.main()
+        Coordinates.geodata.close()
 
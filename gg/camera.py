@@ -33,11 +33,10 @@ from __future__ import division
 from gi.repository import Gio, GObject, Gtk
 from math import modf as split_float
 from gettext import gettext as _
-from time import tzset
-from os import environ
 
 from territories import tz_regions, get_timezone
-from common import get_obj, GSettings, Builder
+from timezones import get_zone
+from common import get_obj, gst, batch, GSettings, Builder
 from version import PACKAGE
 
 BOTTOM = Gtk.PositionType.BOTTOM
@@ -68,6 +67,7 @@ def get_camera(photo):
     
     camera = known_cameras[camera_id]
     camera.photos.add(photo)
+    camera.retimed.clear()
     return camera
 
 def display_offset(offset, value, add, subtract):
@@ -82,6 +82,7 @@ class Camera():
     def __init__(self, camera_id, make, model):
         """Generate Gtk widgets and bind their properties to GSettings."""
         self.photos = set()
+        self.retimed = set()
         
         empty_camera_label.hide()
         
@@ -124,6 +125,9 @@ class Camera():
         self.make      = make
         self.model     = model
         
+        # Binding the offset below calls offset_handler right away.
+        self.timezone = get_zone('')
+        
         self.gst = GSettings('camera', camera_id)
         
         self.gst.set_string('make', make)
@@ -133,12 +137,22 @@ class Camera():
         self.gst.bind('timezone-method', timezone, 'active-id')
         self.gst.bind('timezone-region', tz_region, 'active')
         self.gst.bind('timezone-cities', tz_cities, 'active')
+        
+        # Timezones are often found in the background, after the photos
+        # have already been loaded, see Photograph.set_geodata.
+        self.gst.connect('changed::found-timezone', self.found_handler)
+        
+        # Switching between raw and smoothed tracks moves the photos, but
+        # only once the tracks have been smoothed, see TrackFile.smooth.
+        gst.connect_after('changed::smooth-tracks',
+                          lambda *x: self.set_timezone())
     
     def method_handler(self, method, region, cities):
         """Only show manual tz selectors when necessary."""
         visible = method.get_active_id() == 'custom'
         region.set_visible(visible)
         cities.set_visible(visible)
+        self.retimed.clear()
         self.set_timezone()
     
     def region_handler(self, region, cities):
@@ -152,30 +166,71 @@ class Camera():
         if cities.get_active_id() is not None:
             self.set_timezone()
     
+    def found_handler(self, gst, key):
+        """Retime the photos when a timezone is found that applies to them.
+        
+        Retiming moves the photos, which can find yet another timezone (eg,
+        near a border crossing, where each zone places the photos in the
+        other), so each timezone is only tried once until the camera gets
+        new photos or a new timezone method.
+        """
+        found = gst.get_string(key)
+        if found in self.retimed:
+            return
+        if gst.get_string('timezone-method') != 'lookup':
+            return
+        self.retimed.add(found)
+        batch.retime(self)
+    
     def set_found_timezone(self, found):
         """Store discovered timezone in GSettings."""
-        self.gst.set_string('found-timezone', found)
+        if found != self.gst.get_string('found-timezone'):
+            self.gst.set_string('found-timezone', found)
     
     def set_timezone(self):
         """Set the timezone to the chosen zone and update all photos."""
-        environ['TZ'] = ''
+        name = ''
         case = lambda x, y=self.tz_method.get_active_id(): x == y
         if case('lookup'):
             # Note that this will gracefully fallback on system timezone
             # if no timezone has actually been found yet.
-            environ['TZ'] = self.gst.get_string('found-timezone')
+            name = self.gst.get_string('found-timezone')
         elif case('custom'):
             region = self.tz_region.get_active_id()
             city   = self.tz_cities.get_active_id()
             if region is not None and city is not None:
-                environ['TZ'] = '/'.join([region, city])
-        tzset()
+                name = '/'.join([region, city])
+        self.timezone = get_zone(name)
         self.offset_handler()
     
     def offset_handler(self, offset=None):
-        """When the offset is changed, update the loaded photos."""
-        for photo in self.photos:
-            photo.calculate_timestamp()
+        """When the offset is changed, update the loaded photos.
+        
+        All of the photos are converted into UTC at once, see
+        TimeZone.to_utc_many.
+        """
+        local = [photo for photo in self.photos if photo.local_time is not None]
+        found = {}
+        if local:
+            found = dict(zip(local, self.timezone.to_utc_many(
+                [photo.local_time for photo in local])))
+        with batch:
+            for photo in self.photos:
+                photo.calculate_timestamp(found.get(photo))
+    
+    def suggest_offset(self, photo, timestamp):
+        """Suggest a clock offset that would put the photo at the given time.
+        
+        This is used when the user drags a photo onto the GPS track, because
+        then we know when they were there, and how wrong the clock was.
+        """
+        offset = self.get_offset() + timestamp - photo.timestamp
+        adjustment = self.offset.get_adjustment()
+        if adjustment.get_lower() <= offset <= adjustment.get_upper():
+            self.offset.set_tooltip_text(display_offset(None, offset,
+                _('The GPS track suggests adding %dm, %ds to the clock.'),
+                _('The GPS track suggests subtracting %dm, %ds from the clock.')))
+            return offset
     
     def get_offset(self):
         """Return the currently selected clock offset value."""
@@ -0,0 +1,297 @@
+# Copyright (C) 2012 Robert Park <rbpark@exolucere.ca>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Read the geonames.org cities database without parsing any text.
+
+At build time, the tab-separated cities.txt is converted into cities.db,
+which is laid out like this (all little-endian):
+
+    header      magic, number of cities, number of strings
+    latitudes   one float per city, sorted from south to north
+    longitudes  one float per city
+    records     four string numbers per city: name, state, country, tz
+    population  one integer per city
+    alternates  one string number per city, of its comma separated
+                alternate names
+    offsets     where each string starts in the string table, plus the end
+    strings     every distinct string, stored only once
+
+At runtime the file is memory mapped, so opening it costs nothing, and only
+the pages that are actually needed ever get read from disk.
+
+The geocoder and the search both read it from their own worker threads, so
+whatever is set up lazily is set up under a lock, and published last.
+"""
+
+from __future__ import division
+
+from mmap import mmap, ACCESS_READ
+from math import sin, cos, radians
+from os.path import join
+from os import stat
+from struct import Struct
+from bisect import bisect
+from array import array
+from sys import byteorder
+from threading import RLock
+
+from build_info import PKG_DATA_DIR
+
+MAGIC  = 'GGCITY02'
+HEADER = Struct('<8sII')
+RECORD = Struct('<4I')
+OFFSET = Struct('<I')
+SPAN   = Struct('<2I')
+
+def floats(values):
+    """Pack a list of floats into little-endian single precision."""
+    packed = array('f', values)
+    if byteorder == 'big':
+        packed.byteswap()
+    return packed.tostring()
+
+def unpack_floats(data):
+    """Unpack little-endian single precision floats into an array."""
+    unpacked = array('f', data)
+    if byteorder == 'big':
+        unpacked.byteswap()
+    return unpacked
+
+def integers(values):
+    """Pack a list of integers into little-endian unsigned 32 bit."""
+    return Struct('<%dI' % len(values)).pack(*values)
+
+def build_database(source, destination):
+    """Convert a tab-separated cities.txt into a binary cities.db.
+    
+    This is the six column format written by older versions of
+    update_cities.py, which has no alternate names, optionally followed by
+    a seventh column of populations. Without them every population is zero,
+    and search results can't be ranked by size, so cities.db is better built
+    straight from a geonames.org dump with update_cities.build.
+    """
+    rows = []
+    with open(source) as cities:
+        for line in cities:
+            col = line.rstrip('\n').split('\t')
+            name, lat, lon, country, state, tz = col[0:6]
+            people = int(col[6] or 0) if len(col) > 6 else 0
+            rows.append((float(lat), float(lon), name, state, country,
+                         tz.strip(), people, ''))
+    write_database(rows, destination)
+
+def write_database(rows, destination):
+    """Write a binary cities.db.
+    
+    Each row is a tuple of (lat, lon, name, state, country, tz, population,
+    alternate names).
+    """
+    rows = sorted(rows)
+    strings, interned = [], {}
+    def intern(string):
+        """Number each distinct string in the order it is first seen."""
+        if string not in interned:
+            interned[string] = len(strings)
+            strings.append(string)
+        return interned[string]
+    
+    records = [RECORD.pack(*[intern(s) for s in row[2:6]]) for row in rows]
+    alternates = [intern(row[7]) for row in rows]
+    offsets = [0]
+    for string in strings:
+        offsets.append(offsets[-1] + len(string))
+    
+    with open(destination, 'wb') as db:
+        db.write(HEADER.pack(MAGIC, len(rows), len(strings)))
+        db.write(floats([row[0] for row in rows]))
+        db.write(floats([row[1] for row in rows]))
+        db.write(''.join(records))
+        db.write(integers([row[6] for row in rows]))
+        db.write(integers(alternates))
+        db.write(integers(offsets))
+        db.write(''.join(strings))
+
+
+class CityDatabase():
+    """A memory mapped cities.db, opened the first time it is needed."""
+    
+    def __init__(self, filename):
+        self.filename = filename
+        self.data     = None
+        self.count    = 0
+        self.lats     = None
+        self.lons     = None
+        self.people   = None
+        self.lock     = RLock()
+    
+    def open(self):
+        """Map the file and find where each of its sections begin."""
+        if self.data is not None:
+            return
+        with self.lock:
+            if self.data is not None:
+                return
+            with open(self.filename, 'rb') as db:
+                data = mmap(db.fileno(), 0, access=ACCESS_READ)
+            magic, self.count, strings = HEADER.unpack_from(data)
+            if magic != MAGIC:
+                data.close()
+                raise IOError('%s is not a cities database.' % self.filename)
+            size = 4 * self.count
+            self.lat_start    = HEADER.size
+            self.lon_start    = self.lat_start + size
+            self.record_start = self.lon_start + size
+            self.people_start = self.record_start + RECORD.size * self.count
+            self.alt_start    = self.people_start + size
+            self.offset_start = self.alt_start + size
+            self.string_start = self.offset_start + OFFSET.size * (strings + 1)
+            self.data = data
+    
+    def __len__(self):
+        self.open()
+        return self.count
+    
+    def version(self):
+        """Identify this build of the database, for caches of its results."""
+        try:
+            info = stat(self.filename)
+        except OSError:
+            return ''
+        return '%s:%d:%d' % (MAGIC, info.st_size, info.st_mtime)
+    
+    def coordinates(self):
+        """Copy the coordinate arrays out of the file, for fast scanning.
+        
+        This only happens the first time a nearest city is searched for, and
+        is a straight copy, not a parse.
+        """
+        if self.lats is None:
+            self.open()
+            with self.lock:
+                if self.lats is None:
+                    self.lons = unpack_floats(
+                        self.data[self.lon_start:self.record_start])
+                    self.lats = unpack_floats(
+                        self.data[self.lat_start:self.lon_start])
+        return self.lats, self.lons
+    
+    def string(self, number):
+        """Return the string with the given number from the string table."""
+        position = self.offset_start + OFFSET.size * number
+        start, end = SPAN.unpack_from(self.data, position)
+        return self.data[self.string_start + start:self.string_start + end]
+    
+    def city(self, i):
+        """Return the name, state, country, and timezone of a city."""
+        self.open()
+        return [self.string(number) for number in
+                RECORD.unpack_from(self.data, self.record_start + RECORD.size * i)]
+    
+    def name(self, i):
+        """Return only the name of a city."""
+        self.open()
+        return self.string(OFFSET.unpack_from(self.data,
+                           self.record_start + RECORD.size * i)[0])
+    
+    def population(self, i):
+        """Return how many people live in a city, if known, or else zero."""
+        self.open()
+        return OFFSET.unpack_from(self.data, self.people_start + 4 * i)[0]
+    
+    def populations(self):
+        """Copy the population array out of the file, for fast ranking."""
+        if self.people is None:
+            self.open()
+            with self.lock:
+                if self.people is None:
+                    self.people = Struct('<%dI' % self.count).unpack_from(
+                        self.data, self.people_start)
+        return self.people
+    
+    def alternates(self, i):
+        """Return a list of the other names that a city is known by."""
+        self.open()
+        names = self.string(OFFSET.unpack_from(self.data,
+                            self.alt_start + 4 * i)[0])
+        return names.split(',') if names else []
+    
+    def location(self, i):
+        """Return the latitude and longitude of a city."""
+        lats, lons = self.coordinates()
+        return lats[i], lons[i]
+    
+    def nearest(self, lat, lon, hint=None):
+        """Find the number of the city nearest to the given coordinates.
+        
+        Because the cities are sorted by latitude, the search starts at the
+        given latitude and sweeps north and south, stopping in each direction
+        as soon as the difference in latitude alone is further away than the
+        nearest city found so far. The hint is the number of a city that is
+        probably nearby, which lets the sweep stop almost immediately.
+        """
+        lats, lons = self.coordinates()
+        total = len(lats)
+        lat1, lon1 = radians(lat), radians(lon)
+        cos1 = cos(lat1)
+        haversine = lambda i: (sin((radians(lats[i]) - lat1) / 2) ** 2 +
+            cos1 * cos(radians(lats[i])) * sin((radians(lons[i]) - lon1) / 2) ** 2)
+        best, found = float('inf'), None
+        if hint is not None:
+            best, found = haversine(hint), hint
+        north = bisect(lats, lat)
+        south = north - 1
+        while south >= 0 or north < total:
+            for i in (south, north):
+                if not 0 <= i < total:
+                    continue
+                # Haversine, without the conversion into kilometres. The
+                # latitude term alone is a lower bound on the whole thing.
+                lat2  = radians(lats[i])
+                bound = sin((lat2 - lat1) / 2) ** 2
+                if bound > best:
+                    if i == south:
+                        south = -1
+                    else:
+                        north = total
+                    continue
+                hav = bound + cos1 * cos(lat2) * sin(
+                    (radians(lons[i]) - lon1) / 2) ** 2
+                if hav < best:
+                    best, found = hav, i
+            south -= 1
+            north += 1
+        return found
+    
+    def nearest_many(self, lats, lons):
+        """Find the nearest city to each of many coordinates at once.
+        
+        The coordinates are visited in order of latitude, and each search is
+        seeded with the answer to the previous one. Photos tend to be taken
+        near each other, so most searches end after looking at only a few
+        cities, and repeated coordinates aren't searched again at all.
+        """
+        results = [None] * len(lats)
+        order = sorted(xrange(len(lats)), key=lambda i: (lats[i], lons[i]))
+        last, found = None, None
+        for i in order:
+            here = (lats[i], lons[i])
+            if here != last:
+                found = self.nearest(lats[i], lons[i], found)
+                last = here
+            results[i] = found
+        return results
+
+
+cities = CityDatabase(join(PKG_DATA_DIR, 'cities.db'))
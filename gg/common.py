@@ -19,25 +19,37 @@ The `selected` and `modified` set()s contain Photograph() instances, and
 are frequently used for iteration and membership testing throughout the app.
 
 The `points` dict maps epoch seconds to ChamplainCoordinate() instances. This
-is used to place photos on the map by looking up their timestamps.
+is used to place photos on the map by looking up their timestamps. It also
+keeps its timestamps in order, see Timeline.
 
 The `photos` dict maps absolute filename paths to Photograph() instances, and
 is used for most of the photo manipulations (eg, loading, saving, etc).
+
+The `batch` object collects photo relocations so that their side effects can
+be applied all at once, see LocationBatch for details.
+
+The `timestamps` object keeps the photos sorted by timestamp, so that when a
+GPS track is loaded or unloaded, only the photos it could affect are found.
 """
 
 from __future__ import division
 
 from gi.repository import Gtk, Gio, GLib
 from gi.repository import GtkChamplain, Champlain
+from bisect import bisect_left, bisect_right
 from os.path import join
 
+from elevation import ElevationModel
+from gpsmath import Coordinates
+from geocoder import geocoder
+from geostore import GeoStore
+from cities import cities
 from build_info import PKG_DATA_DIR
 from version import PACKAGE
 
 # These variables are used for sharing data between classes
 selected = set()
 modified = set()
-points   = {}
 photos   = {}
 
 
@@ -50,6 +62,188 @@ class metadata:
     alpha = float('inf')
 
 
+class LocationBatch():
+    """Collect photo relocations and apply their side effects all at once.
+    
+    Photograph.set_location only records the new coordinates, and leaves the
+    expensive work of moving the ChamplainLabel, looking up the geoname, and
+    refreshing the GtkListStore row to this class. Outside of a batch that
+    work is done immediately, but code that relocates many photos should wrap
+    itself in a `with batch:` block, and then the work is done when the
+    outermost block exits: one pass over all the labels, one pass over all
+    the geonames, and one pass over the GtkListStore, during which
+    row-changed listeners are held off until the end.
+    
+    Cameras whose timezone has changed are retimed in the same way, once
+    each, before any of that, since retiming them moves their photos.
+    """
+    
+    def __init__(self):
+        self.depth     = 0
+        self.pending   = set()
+        self.relocated = set()
+        self.cameras   = set()
+    
+    def __enter__(self):
+        self.depth += 1
+        return self
+    
+    def __exit__(self, *ignore):
+        self.depth -= 1
+        if self.depth == 0:
+            self.flush()
+    
+    def add(self, photo, moved=True):
+        """Record that the given photo has a new location or elevation."""
+        modified.add(photo)
+        self.pending.add(photo)
+        if moved:
+            self.relocated.add(photo)
+        if self.depth == 0:
+            self.flush()
+    
+    def retime(self, camera):
+        """Record that the given camera's photos need new timestamps."""
+        self.cameras.add(camera)
+        if self.depth == 0:
+            self.flush()
+    
+    def discard(self, photo):
+        """Forget about a photo that is going away."""
+        self.pending.discard(photo)
+        self.relocated.discard(photo)
+    
+    def flush(self):
+        """Apply all pending changes, one kind of work at a time."""
+        if self.cameras:
+            # The photos that this moves are flushed when the block exits.
+            cameras, self.cameras = self.cameras, set()
+            with self:
+                for camera in cameras:
+                    camera.set_timezone()
+            return
+        if not self.pending:
+            return
+        pending,   self.pending   = self.pending,   set()
+        relocated, self.relocated = self.relocated, set()
+        photo = next(iter(pending))
+        
+        self.depth += 1
+        try:
+            for moved in relocated:
+                moved.position_label()
+            geocoder.locate(relocated)
+            for changed in pending:
+                changed.modify_summary()
+        finally:
+            self.depth -= 1
+        
+        # Let the row-changed listeners know about all of it at once.
+        # Any of the rows will do, since they look at the whole store.
+        liststore = photo.liststore
+        liststore.row_changed(liststore.get_path(photo.iter), photo.iter)
+        
+        # Geonames found along the way may have found new timezones too.
+        if self.cameras:
+            self.flush()
+
+
+batch = LocationBatch()
+
+
+class TimestampIndex():
+    """Find the photos that were taken during a given span of time.
+    
+    Timestamps change far more often (eg, every photo of a camera whenever
+    its clock offset is adjusted) than spans of time are asked about, so
+    updates are just recorded, and the sorted lists are only rebuilt when
+    the next range query comes along.
+    """
+    
+    def __init__(self):
+        self.stamps = {}
+        self.keys   = []
+        self.values = []
+        self.dirty  = False
+    
+    def update(self, photo):
+        """Record the current timestamp of the photo."""
+        self.stamps[photo] = photo.timestamp
+        self.dirty = True
+    
+    def discard(self, photo):
+        """Forget about a photo that is going away."""
+        if self.stamps.pop(photo, None) is not None:
+            self.dirty = True
+    
+    def clear(self):
+        """Forget about all photos."""
+        self.stamps.clear()
+        self.dirty = True
+    
+    def between(self, start, end):
+        """Return the photos with timestamps from start to end, inclusive."""
+        if self.dirty:
+            ordered = sorted((stamp, photo.filename, photo)
+                             for photo, stamp in self.stamps.items())
+            self.keys   = [stamp for stamp, name, photo in ordered]
+            self.values = [photo for stamp, name, photo in ordered]
+            self.dirty  = False
+        return self.values[bisect_left(self.keys, start):
+                           bisect_right(self.keys, end)]
+
+
+timestamps = TimestampIndex()
+
+
+class Timeline(dict):
+    """The fused track points of every loaded track file, by timestamp.
+    
+    The timestamps are also kept in a sorted list, so that a span of time
+    can be replaced when a track file is loaded or unloaded, without
+    touching the rest of the timeline.
+    """
+    
+    def __init__(self):
+        dict.__init__(self)
+        self.stamps = []
+    
+    def replace(self, start, end, found):
+        """Replace the points from start to end, inclusive.
+        
+        The found argument is an iterable of (timestamp, point) pairs, in
+        order, all from start to end.
+        """
+        lo = bisect_left(self.stamps, start)
+        hi = bisect_right(self.stamps, end)
+        for stamp in self.stamps[lo:hi]:
+            del self[stamp]
+        stamps = []
+        for stamp, point in found:
+            self[stamp] = point
+            stamps.append(stamp)
+        self.stamps[lo:hi] = stamps
+    
+    def before(self, stamp):
+        """Return the last timestamp before the given one, or -inf."""
+        index = bisect_left(self.stamps, stamp)
+        return self.stamps[index - 1] if index else float('-inf')
+    
+    def after(self, stamp):
+        """Return the first timestamp after the given one, or inf."""
+        index = bisect_right(self.stamps, stamp)
+        return (self.stamps[index] if index < len(self.stamps) else
+                float('inf'))
+    
+    def clear(self):
+        """Forget about all points."""
+        dict.clear(self)
+        del self.stamps[:]
+
+
+points = Timeline()
+
+
 # This function is the embodiment of my applications core logic.
 # Everything else is just implementation details.
 def auto_timestamp_comparison(photo):
@@ -65,31 +259,53 @@ def auto_timestamp_comparison(photo):
         metadata.alpha),
         metadata.omega)
     
+    # Either follow the track as it was recorded, or the smoothed version.
+    coords = ((lambda point: point.smooth)
+              if gst.get_boolean('smooth-tracks') else
+              (lambda point: (point.lat, point.lon)))
+    
     try:
-        point = points[stamp] # Try to use an exact match,
-        lat   = point.lat     # if such a thing were to exist.
-        lon   = point.lon     # It's more likely than you think. 50%
-        ele   = point.ele     # of the included demo data matches here.
+        point    = points[stamp] # Try to use an exact match,
+        lat, lon = coords(point) # if such a thing were to exist.
+        ele      = point.ele     # It's more likely than you think. 50%
+                                 # of the included demo data matches here.
     
     except KeyError:
         # Find the two points that are nearest (in time) to the photo.
-        hi = min([point for point in points if point > stamp])
-        lo = max([point for point in points if point < stamp])
+        hi = points.after(stamp)
+        lo = points.before(stamp)
         hi_point = points[hi]
         lo_point = points[lo]
         hi_ratio = (stamp - lo) / (hi - lo)  # Proportional amount of time
         lo_ratio = (hi - stamp) / (hi - lo)  # between each point & the photo.
+        hi_lat, hi_lon = coords(hi_point)
+        lo_lat, lo_lon = coords(lo_point)
         
         # Find intermediate values using the proportional ratios.
-        lat = ((lo_point.lat * lo_ratio)  +
-               (hi_point.lat * hi_ratio))
-        lon = ((lo_point.lon * lo_ratio)  +
-               (hi_point.lon * hi_ratio))
+        lat = ((lo_lat * lo_ratio)  +
+               (hi_lat * hi_ratio))
+        lon = ((lo_lon * lo_ratio)  +
+               (hi_lon * hi_ratio))
         ele = ((lo_point.ele * lo_ratio)  +
                (hi_point.ele * hi_ratio))
     
     photo.set_location(lat, lon, ele)
 
+def retag_photos(start, end):
+    """Re-interpolate the photos affected by track points from start to end.
+    
+    Photos are placed between the track points on either side of them, so
+    only photos between the last point before start and the first point
+    after end can possibly have moved. Photos before the first point or
+    after the last point are clamped to it, so if there is no such point,
+    the span extends forever in that direction.
+    """
+    with batch:
+        for photo in timestamps.between(points.before(start),
+                                        points.after(end)):
+            if photo.label is not None:
+                auto_timestamp_comparison(photo)
+
 
 class Builder(Gtk.Builder):
     """Load GottenGeography's UI definitions."""
@@ -167,8 +383,27 @@ class Struct:
         self.__dict__.update(attributes)
 
 
+def elevation_directory():
+    """Determine where the user keeps their elevation tiles."""
+    return (gst.get_string('elevation-directory') or
+            join(GLib.get_user_data_dir(), PACKAGE, 'elevation'))
+
+
 # Initialize GtkBuilder, Champlain, and GSettings
 get_obj  = Builder().get_object
 map_view = ChamplainEmbedder().get_view()
 gst      = GSettings()
 
+# Ground elevations, for anywhere that the user has elevation tiles for.
+dem = ElevationModel(elevation_directory())
+gst.connect('changed::elevation-directory',
+    lambda *args: dem.set_directory(elevation_directory()))
+
+# Reverse geocoding results, shared by everything that has coordinates,
+# and remembered from one session to the next.
+Coordinates.geodata.store = GeoStore(
+    join(GLib.get_user_cache_dir(), PACKAGE, 'geodata.sqlite'),
+    cities.version())
+Coordinates.geodata.resize(gst.get_int('geodata-cache-size'))
+gst.connect('changed::geodata-cache-size',
+    lambda *args: Coordinates.geodata.resize(gst.get_int('geodata-cache-size')))
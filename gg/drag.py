@@ -37,7 +37,7 @@ from __future__ import division
 from gi.repository import Gtk, Gdk
 from urlparse import urlparse
 
-from common import Struct, get_obj, map_view, selected, modified, photos
+from common import Struct, get_obj, map_view, selected, photos, batch, dem
 
 class DragController():
     """Control the drag & drop behavior."""
@@ -86,14 +86,15 @@ class DragController():
         self.external_drag = True
         
         if on_map:
-          for filename in files:
-                photo = photos.get(filename)
-                if photo is not None:
-                    photo.manual = True
-                    photo.set_location(
-                        map_view.y_to_latitude(y),
-                        map_view.x_to_longitude(x))
-                    modified.add(photo)
+            lat = map_view.y_to_latitude(y)
+            lon = map_view.x_to_longitude(x)
+            ele = dem.elevation(lat, lon)
+            with batch:
+                for filename in files:
+                    photo = photos.get(filename)
+                    if photo is not None:
+                        photo.manual = True
+                        photo.set_location(lat, lon, ele)
         
         self.selection.emit('changed')
         map_view.emit('animation-completed')
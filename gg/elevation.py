@@ -0,0 +1,165 @@
+# Copyright (C) 2012 Robert Park <rbpark@exolucere.ca>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Look up ground elevation from SRTM/ASTER digital elevation model tiles.
+
+Each .hgt tile covers one degree of latitude by one degree of longitude, and
+is named after its south-west corner, eg N53W114.hgt. The file is a square
+grid of big-endian signed 16 bit integers measuring metres above sea level,
+stored in rows from north to south. SRTM3 tiles are 1201 samples square,
+while SRTM1 and ASTER tiles are 3601 samples square. The tiles overlap their
+neighbours by one row and one column.
+
+Tiles are memory mapped rather than read, so only the pages that are actually
+sampled ever get loaded from disk, and only the most recently used handful of
+tiles are kept open at any given time.
+"""
+
+from __future__ import division
+
+from mmap import mmap, ACCESS_READ
+from collections import OrderedDict
+from os.path import join, isfile
+from struct import Struct
+from math import floor, sqrt
+
+# Samples that the satellite couldn't measure (eg, water, deep shadow).
+VOID = -32768
+
+SAMPLE = Struct('>h')
+
+def tile_name(south, west):
+    """Name the tile that has the given south-west corner."""
+    return '%s%02d%s%03d.hgt' % (
+        'N' if south >= 0 else 'S', abs(south),
+        'E' if west  >= 0 else 'W', abs(west))
+
+
+class Tile():
+    """A single memory mapped .hgt file."""
+    
+    def __init__(self, filename, south, west):
+        with open(filename, 'rb') as hgt:
+            self.data = mmap(hgt.fileno(), 0, access=ACCESS_READ)
+        self.size  = int(sqrt(len(self.data) // 2))
+        self.south = south
+        self.west  = west
+        if self.size < 2 or self.size ** 2 * 2 != len(self.data):
+            self.close()
+            raise IOError
+    
+    def sample(self, row, col):
+        """Read one raw sample, or None if it's a void."""
+        value = SAMPLE.unpack_from(self.data, 2 * (row * self.size + col))[0]
+        return None if value == VOID else value
+    
+    def elevation(self, lat, lon):
+        """Bilinearly interpolate between the four surrounding samples.
+        
+        Voids are left out of the interpolation, and None is returned if
+        only voids are left.
+        """
+        last = self.size - 1
+        y = (self.south + 1 - lat) * last
+        x = (lon - self.west) * last
+        row = min(max(int(y), 0), last - 1)
+        col = min(max(int(x), 0), last - 1)
+        dy, dx = y - row, x - col
+        
+        total = weight = 0
+        for r, c, w in ((row,     col,     (1 - dy) * (1 - dx)),
+                        (row,     col + 1, (1 - dy) * dx),
+                        (row + 1, col,     dy * (1 - dx)),
+                        (row + 1, col + 1, dy * dx)):
+            value = self.sample(r, c)
+            if value is not None:
+                total  += value * w
+                weight += w
+        if weight > 0:
+            return total / weight
+    
+    def close(self):
+        """Unmap the file."""
+        self.data.close()
+
+
+class ElevationModel():
+    """Find the ground elevation anywhere that there is a tile available.
+    
+    Tiles that don't exist are remembered as such, so asking repeatedly
+    about places that aren't covered costs nothing more than a dict lookup.
+    """
+    
+    def __init__(self, directory='', max_tiles=8):
+        self.directory = directory
+        self.max_tiles = max_tiles
+        self.tiles     = OrderedDict()
+    
+    def set_directory(self, directory):
+        """Look for tiles somewhere else, forgetting the ones already open."""
+        self.directory = directory
+        for tile in self.tiles.values():
+            if tile is not None:
+                tile.close()
+        self.tiles.clear()
+    
+    def get_tile(self, south, west):
+        """Return the Tile with the given south-west corner, or None."""
+        key = (south, west)
+        try:
+            tile = self.tiles.pop(key)
+        except KeyError:
+            tile = None
+            filename = join(self.directory, tile_name(south, west))
+            if self.directory and isfile(filename):
+                try:
+                    tile = Tile(filename, south, west)
+                except (IOError, ValueError, EnvironmentError):
+                    pass
+            while len(self.tiles) >= self.max_tiles:
+                old = self.tiles.popitem(last=False)[1]
+                if old is not None:
+                    old.close()
+        
+        # Re-inserting the key marks it as the most recently used.
+        self.tiles[key] = tile
+        return tile
+    
+    def elevation(self, lat, lon):
+        """Return the elevation at the given coordinates, or None."""
+        return self.elevations([lat], [lon])[0]
+    
+    def elevations(self, lats, lons):
+        """Return a list of elevations for the given lists of coordinates.
+        
+        The coordinates are grouped by tile first, so that each tile is only
+        looked up (and possibly mapped) once no matter how many points fall
+        inside it, or in which order they were given.
+        """
+        results = [None] * len(lats)
+        by_tile = {}
+        for i, lat, lon in zip(xrange(len(lats)), lats, lons):
+            if lat is None or lon is None:
+                continue
+            key = (int(floor(lat)), int(floor(lon)))
+            by_tile.setdefault(key, []).append(i)
+        
+        for (south, west), indices in by_tile.items():
+            tile = self.get_tile(south, west)
+            if tile is None:
+                continue
+            for i in indices:
+                results[i] = tile.elevation(lats[i], lons[i])
+        return results
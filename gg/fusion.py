@@ -0,0 +1,111 @@
+# Copyright (C) 2012 Robert Park <rbpark@exolucere.ca>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Fuse the tracks from several GPS devices into a single timeline.
+
+When more than one device was logging at the same time, simply combining
+all of their points would make photos zig-zag between where each device
+thought it was. Instead, the time-sorted points of every device are merged
+together in a single streaming pass, and each point is only kept if no
+better device was also logging at that moment.
+
+A device is better if the user gave it a higher priority, or failing that,
+if its points had a lower dilution of precision, or failing that, if it
+was loaded first.
+"""
+
+from __future__ import division
+
+from heapq import heappush, heappop
+from itertools import count
+
+# Devices that go quiet for longer than this many seconds aren't considered
+# to have been logging in between their points.
+MAX_GAP = 60
+
+# The dilution of precision assumed for points that didn't record one.
+DEFAULT_DOP = 5.0
+
+def dilution(hdop=None, sats=None):
+    """Estimate how imprecise a point is from whatever the GPS recorded."""
+    try:
+        return float(hdop)
+    except (TypeError, ValueError):
+        pass
+    try:
+        return 10 / max(int(sats), 1)
+    except (TypeError, ValueError):
+        return DEFAULT_DOP
+
+def fuse(sources, max_gap=MAX_GAP):
+    """Merge several streams of points into one, lazily.
+    
+    The sources argument is a list of (priority, points) pairs, where points
+    is an iterable of (timestamp, dop, value) tuples sorted by timestamp.
+    Generates (timestamp, value) pairs in order, one per timestamp. Only the
+    head of each source is held in memory at any time.
+    """
+    heads = []
+    order = count()
+    streams = []
+    after = []     # The (timestamp, dop) of each source's next point
+    before = []    # The (timestamp, dop) of each source's previous point
+    ranks = []
+    
+    def advance(i):
+        """Queue up the next point from the given source."""
+        for timestamp, dop, value in streams[i]:
+            after[i] = (timestamp, dop)
+            heappush(heads, (timestamp, ranks[i], dop, i, next(order), value))
+            return
+        after[i] = None
+    
+    for i, (priority, points) in enumerate(sources):
+        streams.append(iter(points))
+        ranks.append(-priority)
+        after.append(None)
+        before.append(None)
+        advance(i)
+    
+    def beaten(i, timestamp, dop):
+        """Determine if any other source was doing better at the time."""
+        mine = (ranks[i], dop, i)
+        for j in xrange(len(streams)):
+            if j == i or after[j] is None:
+                continue
+            nxt_time, nxt_dop = after[j]
+            if before[j] is None:
+                if nxt_time != timestamp:
+                    continue
+                prv_time, prv_dop = after[j]
+            else:
+                prv_time, prv_dop = before[j]
+            if not prv_time <= timestamp <= nxt_time:
+                continue
+            if nxt_time - prv_time > max_gap:
+                continue
+            if (ranks[j], max(prv_dop, nxt_dop), j) < mine:
+                return True
+        return False
+    
+    last = None
+    while heads:
+        timestamp, rank, dop, i, n, value = heappop(heads)
+        before[i] = (timestamp, dop)
+        advance(i)
+        if timestamp == last or beaten(i, timestamp, dop):
+            continue
+        last = timestamp
+        yield timestamp, value
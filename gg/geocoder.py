@@ -0,0 +1,143 @@
+# Copyright (C) 2012 Robert Park <rbpark@exolucere.ca>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Reverse geocode in the background, so that the map never freezes.
+
+Places that are already in the geodata cache are answered immediately. All
+others are handed to a worker thread, which searches the cities database
+and then hands its answers back to the main loop with GLib.idle_add, since
+only the main thread is allowed to touch Gtk or the geodata cache. Any
+number of requests for the same place only result in one search.
+
+Until the main loop is running there is nobody to deliver the answers, so
+until then (eg, while running the test suite), lookups are synchronous.
+
+If a search fails (eg, cities.db is missing), its callbacks are given None
+instead of an answer, so that nothing waits forever, and the error is raised
+again in the main loop to be reported.
+"""
+
+from gi.repository import GLib
+from threading import Thread
+from Queue import Queue, Empty
+from functools import partial
+from itertools import izip
+
+from gpsmath import Coordinates
+from cities import cities
+
+
+class Geocoder():
+    """Look up geonames on a worker thread."""
+    
+    def __init__(self):
+        self.threaded = False
+        self.requests = Queue()
+        self.waiting  = {}
+        self.worker   = None
+    
+    def lookup(self, lat, lon, callback):
+        """Call the callback with the geodata of the given coordinates."""
+        self.lookup_many([(lat, lon, callback)])
+    
+    def lookup_many(self, requests):
+        """Look up many (lat, lon, callback) requests at once.
+        
+        Callbacks for places that are already known are called before this
+        returns, and the rest are called from the main loop later on.
+        """
+        geodata = Coordinates.geodata
+        known, unknown = {}, {}
+        for lat, lon, callback in requests:
+            key = geodata.key(lat, lon)
+            if key in known:
+                callback(known[key])
+                continue
+            if key not in self.waiting:
+                data = geodata.get(key)
+                if data is not None:
+                    known[key] = data
+                    callback(data)
+                    continue
+                self.waiting[key] = []
+                unknown[key] = (lat, lon)
+            self.waiting[key].append(callback)
+        
+        if not unknown:
+            return
+        if not self.threaded:
+            self.deliver(self.search(unknown))
+            return
+        self.requests.put(unknown)
+        if self.worker is None:
+            self.worker = Thread(target=self.work, name='geocoder')
+            self.worker.daemon = True
+            self.worker.start()
+    
+    def locate(self, photos):
+        """Look up the geonames of many photos.
+        
+        Photos show a placeholder until their geoname is known, see
+        Photograph.geodata_found.
+        """
+        requests = []
+        for photo in photos:
+            if photo.valid_coords():
+                key = Coordinates.geodata.key(photo.latitude, photo.longitude)
+                photo.locating = key
+                requests.append((photo.latitude, photo.longitude,
+                                 partial(photo.geodata_found, key)))
+        self.lookup_many(requests)
+    
+    def search(self, places):
+        """Find the nearest cities to a dict of key: (lat, lon) pairs."""
+        lats = [lat for lat, lon in places.values()]
+        lons = [lon for lat, lon in places.values()]
+        return dict(izip(places.keys(), [cities.city(i) for i in
+                                         cities.nearest_many(lats, lons)]))
+    
+    def work(self):
+        """Answer requests forever, all the ones that have piled up at once."""
+        while True:
+            places = self.requests.get()
+            try:
+                while True:
+                    places.update(self.requests.get_nowait())
+            except Empty:
+                pass
+            try:
+                answers = self.search(places)
+            except Exception as error:
+                GLib.idle_add(self.fail, places, error)
+                continue
+            GLib.idle_add(self.deliver, answers)
+    
+    def deliver(self, answers):
+        """Remember the answers and pass them along, in the main thread."""
+        geodata = Coordinates.geodata
+        for key, data in answers.items():
+            if data is not None:
+                geodata[key] = data
+            for callback in self.waiting.pop(key, []):
+                callback(data)
+        return False
+    
+    def fail(self, places, error):
+        """Give up on places that couldn't be searched, in the main thread."""
+        self.deliver(dict.fromkeys(places))
+        raise error
+
+
+geocoder = Geocoder()
@@ -0,0 +1,140 @@
+# Copyright (C) 2012 Robert Park <rbpark@exolucere.ca>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Remember reverse geocoding results from one session to the next.
+
+Places are stored in a small sqlite database in the user's cache directory,
+keyed by the same quantized coordinates as the in-memory GeoCache. New
+results aren't written immediately; they are queued up and written in a
+single transaction once enough of them have accumulated, once they have been
+waiting for a while, or when the application exits.
+
+The database records which version of cities.db its results came from, and
+if cities.db has since been rebuilt, all of the results are thrown away.
+"""
+
+from gi.repository import GLib
+from sqlite3 import connect, Error
+from os.path import dirname, isdir
+from os import makedirs
+
+# Write queued results once there are this many of them,
+BATCH_SIZE = 100
+
+# or once the oldest of them has been waiting this many seconds.
+BATCH_DELAY = 30
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS places (
+    lat INTEGER, lon INTEGER, city TEXT, state TEXT, country TEXT, tz TEXT,
+    PRIMARY KEY (lat, lon));
+"""
+
+
+class GeoStore():
+    """A persistent, write-behind store of geodata.
+    
+    The database is opened the first time it is needed. Any error from
+    sqlite (eg, a read-only or corrupt file) just disables the store,
+    because everything in it can always be looked up again.
+    """
+    
+    def __init__(self, filename, version):
+        self.filename = filename
+        self.version  = version
+        self.db       = None
+        self.broken   = False
+        self.pending  = {}
+        self.timer    = None
+    
+    def open(self):
+        """Connect to the database, and empty it if it's out of date."""
+        if self.db is not None or self.broken:
+            return self.db
+        try:
+            if not isdir(dirname(self.filename)):
+                makedirs(dirname(self.filename))
+            self.db = connect(self.filename)
+            self.db.text_factory = str
+            self.db.executescript(SCHEMA)
+            found = self.db.execute(
+                "SELECT value FROM meta WHERE key = 'version'").fetchone()
+            if found is None or found[0] != self.version:
+                self.db.execute('DELETE FROM places')
+                self.db.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)',
+                                ('version', self.version))
+                self.db.commit()
+        except (Error, EnvironmentError):
+            self.disconnect()
+            self.broken = True
+        return self.db
+    
+    def get(self, key):
+        """Return the stored geodata for the key, or None."""
+        if key in self.pending:
+            return self.pending[key]
+        if self.open() is None:
+            return None
+        try:
+            found = self.db.execute('SELECT city, state, country, tz '
+                'FROM places WHERE lat = ? AND lon = ?', key).fetchone()
+        except Error:
+            return None
+        return list(found) if found is not None else None
+    
+    def put(self, key, data):
+        """Queue up geodata to be written later."""
+        if self.broken:
+            return
+        if self.timer is None:
+            self.timer = GLib.timeout_add_seconds(BATCH_DELAY, self.timeout)
+        self.pending[key] = data
+        if len(self.pending) >= BATCH_SIZE:
+            self.flush()
+    
+    def timeout(self):
+        """Write the queue once its oldest geodata has waited long enough."""
+        self.timer = None
+        self.flush()
+        return False
+    
+    def flush(self):
+        """Write all of the queued geodata in a single transaction."""
+        if self.timer is not None:
+            GLib.source_remove(self.timer)
+            self.timer = None
+        pending, self.pending = self.pending, {}
+        if not pending or self.open() is None:
+            return
+        try:
+            self.db.executemany(
+                'INSERT OR REPLACE INTO places VALUES (?, ?, ?, ?, ?, ?)',
+                [key + tuple(data) for key, data in pending.items()])
+            self.db.commit()
+        except Error:
+            self.disconnect()
+            self.broken = True
+    
+    def disconnect(self):
+        """Close the database connection, if there is one."""
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+    
+    def close(self):
+        """Write anything still queued and disconnect."""
+        self.flush()
+        self.disconnect()
@@ -17,19 +17,24 @@
 
 from __future__ import division
 
-from math import acos, sin, cos, radians
+from math import asin, sin, cos, sqrt, radians
 from time import strftime, localtime
 from math import modf as split_float
-from os.path import join, basename
+from os.path import basename
 from gettext import gettext as _
 from fractions import Fraction
+from itertools import izip
+from collections import OrderedDict
 from pyexiv2 import Rational
 
 from territories import get_state, get_country
-from build_info import PKG_DATA_DIR
+from cities import cities
 
 EARTH_RADIUS = 6371 #km
 
+# How many places to remember the geonames of, by default.
+GEODATA_CACHE_SIZE = 10000
+
 def dms_to_decimal(degrees, minutes, seconds, sign=' '):
     """Convert degrees, minutes, seconds into decimal degrees."""
     return (-1 if sign[0] in 'SWsw' else 1) * (
@@ -53,6 +58,13 @@ def float_to_rational(value):
     frac = Fraction(abs(value)).limit_denominator(99999)
     return Rational(frac.numerator, frac.denominator)
 
+def distance(lat1, lon1, lat2, lon2):
+    """Find the great circle distance between two points, in kilometres."""
+    lat1, lon1, lat2, lon2 = map(radians, (lat1, lon1, lat2, lon2))
+    hav = (sin((lat2 - lat1) / 2) ** 2 +
+           cos(lat1) * cos(lat2) * sin((lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS * asin(min(1, sqrt(hav)))
+
 def valid_coords(lat, lon):
     """Determine the validity of coordinates."""
     if type(lat) not in (float, int): return False
@@ -67,6 +79,91 @@ def format_coords(lat, lon):
     )
 
 
+class GeoCache():
+    """Remember the geodata of the most recently looked up places.
+    
+    Places are keyed by their coordinates rounded to two decimal places
+    (roughly one kilometre), stored as a pair of integers. Once the cache
+    is full, the least recently used place is forgotten. The hits, misses
+    and evictions are counted so that the size can be tuned.
+    
+    If there is a store (see GeoStore), places that aren't in memory are
+    looked for there before giving up, and new places are saved there.
+    """
+    
+    def __init__(self, size=GEODATA_CACHE_SIZE, store=None):
+        self.size      = size
+        self.store     = store
+        self.data      = OrderedDict()
+        self.hits      = 0
+        self.loads     = 0
+        self.misses    = 0
+        self.evictions = 0
+    
+    def __len__(self):
+        return len(self.data)
+    
+    def __contains__(self, key):
+        return key in self.data
+    
+    def key(self, lat, lon):
+        """Quantize coordinates into a key."""
+        return (int(round(lat * 100)), int(round(lon * 100)))
+    
+    def get(self, key):
+        """Return the geodata for the key, or None if it isn't known."""
+        try:
+            value = self.data.pop(key)
+        except KeyError:
+            value = self.store.get(key) if self.store is not None else None
+            if value is None:
+                self.misses += 1
+                return None
+            self.loads += 1
+        else:
+            self.hits += 1
+        # Re-inserting the key marks it as the most recently used.
+        self.data[key] = value
+        self.trim()
+        return value
+    
+    def __setitem__(self, key, value):
+        self.data.pop(key, None)
+        self.data[key] = value
+        self.trim()
+        if self.store is not None:
+            self.store.put(key, value)
+    
+    def trim(self):
+        """Forget the least recently used places until there is room."""
+        while len(self.data) > max(self.size, 0):
+            self.data.popitem(last=False)
+            self.evictions += 1
+    
+    def resize(self, size):
+        """Change how many places are remembered."""
+        self.size = size
+        self.trim()
+    
+    def clear(self):
+        """Forget everything in memory, including the counters."""
+        self.data.clear()
+        self.hits = self.loads = self.misses = self.evictions = 0
+    
+    def close(self):
+        """Save anything the store hasn't saved yet."""
+        if self.store is not None:
+            self.store.close()
+    
+    def stats(self):
+        """Summarize how well the cache is working."""
+        total = self.hits + self.loads + self.misses
+        return ('%d/%d places, %d hits, %d loads, %d misses (%.1f%%), '
+                '%d evictions') % (len(self), self.size, self.hits, self.loads,
+            self.misses, 100 * self.misses / total if total else 0,
+            self.evictions)
+
+
 class Coordinates():
     """A generic object containing latitude and longitude coordinates.
     
@@ -76,7 +173,8 @@ class Coordinates():
     The geodata attribute of this class is shared across all instances of
     all subclasses of this class. When it is modified by any instance, the
     changes are immediately available to all other instances. It serves as
-    a cache for data read from cities.txt, which contains geocoding data
+    a bounded cache (see GeoCache) for data read from cities.db, which
+    contains geocoding data
     provided by geonames.org. All subclasses of this class can call
     self.lookup_geoname() and receive cached data if it was already
     looked up by another instance of any subclass.
@@ -93,7 +191,7 @@ class Coordinates():
     longitude = None
     timestamp = None
     timezone  = None
-    geodata   = {}
+    geodata   = GeoCache()
     
     def valid_coords(self):
         """Check if this object contains valid coordinates."""
@@ -105,30 +203,11 @@ class Coordinates():
             self.latitude, self.longitude, link) if self.valid_coords() else ''
     
     def lookup_geoname(self):
-        """Search cities.txt for nearest city."""
+        """Search cities.db for nearest city."""
         if not self.valid_coords():
             return
         assert self.geodata is Coordinates.geodata
-        key = '%.2f,%.2f' % (self.latitude, self.longitude)
-        if key in self.geodata:
-            return self.set_geodata(self.geodata[key])
-        near, dist = None, float('inf')
-        lat1, lon1 = radians(self.latitude), radians(self.longitude)
-        with open(join(PKG_DATA_DIR, 'cities.txt')) as cities:
-            for city in cities:
-                name, lat, lon, country, state, tz = city.split('\t')
-                lat2, lon2 = radians(float(lat)), radians(float(lon))
-                try:
-                    delta = acos(sin(lat1) * sin(lat2) +
-                                 cos(lat1) * cos(lat2) *
-                                 cos(lon2  - lon1))    * EARTH_RADIUS
-                except ValueError:
-                    delta = 0
-                if delta < dist:
-                    dist = delta
-                    near = [name, state, country, tz]
-        self.geodata[key] = near
-        return self.set_geodata(near)
+        return self.set_geodata(geocode([self.latitude], [self.longitude])[0])
     
     def set_geodata(self, data):
         """Apply geodata to internal attributes."""
@@ -173,3 +252,39 @@ class Coordinates():
             'style="italic" size="smaller"', self.short_summary()
         )
 
+def geocode(lats, lons):
+    """Find the city, state, country, and timezone of many coordinates.
+    
+    Coordinates that were looked up before are answered from the memo in
+    Coordinates.geodata, and all of the rest are found with a single pass
+    through the cities database. Returns a list in the same order.
+    """
+    geodata = Coordinates.geodata
+    keys = [geodata.key(lat, lon) for lat, lon in izip(lats, lons)]
+    answers, missing = {}, {}
+    for i, key in enumerate(keys):
+        if key in answers or key in missing:
+            continue
+        data = geodata.get(key)
+        if data is None:
+            missing[key] = i
+        else:
+            answers[key] = data
+    found = cities.nearest_many([lats[i] for i in missing.values()],
+                                [lons[i] for i in missing.values()])
+    for key, city in izip(missing.keys(), found):
+        answers[key] = geodata[key] = cities.city(city)
+    return [answers[key] for key in keys]
+
+def lookup_geonames(instances):
+    """Look up and apply the geodata of many Coordinates instances at once.
+    
+    Instances without valid coordinates are skipped. Returns the timezones
+    of the others.
+    """
+    valid = [instance for instance in instances if instance.valid_coords()]
+    found = geocode([instance.latitude  for instance in valid],
+                    [instance.longitude for instance in valid])
+    for instance, data in izip(valid, found):
+        instance.set_geodata(data)
+    return [instance.timezone for instance in valid]
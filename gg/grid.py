@@ -0,0 +1,137 @@
+# Copyright (C) 2012 Robert Park <rbpark@exolucere.ca>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Find the nearest of a large number of points to any given location.
+
+The points are bucketed into a grid of cells a fixed number of degrees
+wide, so that a search only has to look at the handful of cells around the
+location it's searching, spiralling outwards one ring of cells at a time
+until no unsearched cell could possibly contain anything closer.
+"""
+
+from __future__ import division
+
+from math import floor, cos, radians
+from array import array
+
+from gpsmath import distance, EARTH_RADIUS
+
+# How many kilometres in one degree of latitude.
+KM_PER_DEGREE = radians(EARTH_RADIUS)
+
+
+class GridIndex():
+    """A spatial index of points, each with an arbitrary value attached."""
+    
+    def __init__(self, cell_size=0.01):
+        self.cell_size = cell_size
+        self.cells     = {}
+        self.lats      = array('d')
+        self.lons      = array('d')
+        self.values    = []
+        self.bounds    = None
+        self.max_lat   = 0
+    
+    def __len__(self):
+        return len(self.values)
+    
+    def cell(self, lat, lon):
+        """Return the row and column of the cell containing the location."""
+        return (int(floor(lat / self.cell_size)),
+                int(floor(lon / self.cell_size)))
+    
+    def add(self, lat, lon, value):
+        """Add a point to the index."""
+        row, col = key = self.cell(lat, lon)
+        self.cells.setdefault(key, []).append(len(self.values))
+        self.lats.append(lat)
+        self.lons.append(lon)
+        self.values.append(value)
+        self.max_lat = max(self.max_lat, abs(lat))
+        if self.bounds is None:
+            self.bounds = [row, row, col, col]
+        else:
+            bounds = self.bounds
+            bounds[0], bounds[1] = min(bounds[0], row), max(bounds[1], row)
+            bounds[2], bounds[3] = min(bounds[2], col), max(bounds[3], col)
+    
+    def ring(self, row, col, radius):
+        """Generate the cells that are exactly radius cells away.
+        
+        Cells outside of the area covered by the index are skipped, because
+        they're known to be empty.
+        """
+        top, bottom, left, right = self.bounds
+        first, last = max(col - radius, left), min(col + radius, right)
+        for r in (row - radius, row + radius) if radius else (row,):
+            if top <= r <= bottom:
+                for c in xrange(first, last + 1):
+                    yield (r, c)
+        for c in (col - radius, col + radius) if radius else ():
+            if left <= c <= right:
+                for r in xrange(max(row - radius + 1, top),
+                                min(row + radius - 1, bottom) + 1):
+                    yield (r, c)
+    
+    def nearest(self, lat, lon, within=None):
+        """Find the point nearest to the given location.
+        
+        Returns a tuple of (distance in km, value), or None if the index is
+        empty or nothing is within the given number of kilometres.
+        """
+        if not self.values:
+            return None
+        
+        best, found = self.search(lat, lon,
+            within if within is not None else float('inf'), None)
+        
+        # Longitudes wrap around at 180 degrees, so search again from the
+        # other side of the antimeridian, in case the nearest point is over
+        # there. Usually this gives up before looking at a single cell.
+        best, found = self.search(lat, lon - 360 if lon > 0 else lon + 360,
+                                  best, found)
+        
+        if found is not None:
+            return best, self.values[found]
+    
+    def search(self, lat, lon, best, found):
+        """Look for anything closer to the location than best km away.
+        
+        Returns the new (distance in km, index) of the nearest point, or
+        the given best and found if nothing is any closer.
+        """
+        # The narrowest a cell can be anywhere in the index, in km. A cell
+        # radius rings away can't be any closer than radius - 1 of these.
+        narrowest = (self.cell_size * KM_PER_DEGREE *
+                     max(cos(radians(max(self.max_lat, abs(lat)))), 0.01))
+        
+        row, col = self.cell(lat, lon)
+        top, bottom, left, right = self.bounds
+        farthest = max(abs(row - top), abs(row - bottom),
+                       abs(col - left), abs(col - right))
+        
+        # Nothing is any closer than the edge of the area that is indexed.
+        nearest = max(top - row, row - bottom, left - col, col - right, 0)
+        
+        for radius in xrange(nearest, farthest + 1):
+            if (radius - 1) * narrowest > best:
+                break
+            for key in self.ring(row, col, radius):
+                for i in self.cells.get(key, ()):
+                    dist = distance(lat, lon, self.lats[i], self.lons[i])
+                    if dist <= best:
+                        best, found = dist, i
+        
+        return best, found
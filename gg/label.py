@@ -20,7 +20,11 @@ from __future__ import division
 from gi.repository import Gtk, Champlain, Clutter
 from os.path import basename
 
-from common import get_obj, map_view, selected, modified, photos
+from common import get_obj, map_view, selected, modified, photos, dem
+from xmlfiles import nearest_point
+
+# Photos dropped within this many kilometres of a track are on the track.
+ON_TRACK = 0.05
 
 def update_highlights(selection):
     """Ensure only the selected labels are highlighted."""
@@ -57,9 +61,17 @@ def clicked(label, event, selection):
         selection.select_iter(photo.iter)
 
 def drag_finish(label, event, selection):
-    """Update photos with new locations after photos have been dragged."""
+    """Update photos with new locations after photos have been dragged.
+    
+    If the photo was dropped onto a GPS track, then we know when the photo
+    was really taken and can suggest how wrong the camera clock is.
+    """
     photo = photos[label.get_name()]
-    photo.set_location(label.get_latitude(), label.get_longitude())
+    lat, lon = label.get_latitude(), label.get_longitude()
+    found = nearest_point(lat, lon, ON_TRACK)
+    if found is not None and photo.camera is not None:
+        photo.camera.suggest_offset(photo, found[1])
+    photo.set_location(lat, lon, dem.elevation(lat, lon))
     photo.manual = True
     selection.emit('changed')
     map_view.emit('animation-completed')
@@ -0,0 +1,231 @@
+# coding=UTF-8
+
+# Copyright (C) 2012 Robert Park <rbpark@exolucere.ca>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Find cities by name without looking at every city.
+
+The first time a search is made, every city name is folded into a search key
+(see fold) and the keys are sorted, so that the cities starting with whatever
+has been typed so far are a contiguous range found with two bisects. For
+matches in the middle of a name, there is also a list of the keys that each
+trigram (three letter sequence) occurs in. Only the keys listed under the
+rarest trigram of the search need to be looked at.
+
+Matches are ranked by how well the name matches, by how many people live
+there, and by how close they are to wherever the map is looking. Each city's
+position is kept as a unit vector, so that its closeness is a single dot
+product. Only the best few are kept, using a heap, and the more expensive
+checks of how well the name matches are only made for those.
+"""
+
+from __future__ import division
+
+from unicodedata import normalize, combining
+from bisect import bisect_left
+from heapq import nlargest
+from itertools import chain
+from array import array
+from math import log10, sin, cos, radians
+
+from gpsmath import EARTH_RADIUS
+from cities import cities
+
+# Sorts after any character that can appear in a key.
+LAST = u'\uffff'
+
+# How many search results to show.
+RESULTS = 50
+
+# How much a match is worth, depending on where in the name it is found,
+EXACT, PREFIX, WORD, INFIX = 3, 2, 1, 0
+
+# plus this much for every factor of ten people who live there. So a city of
+# a million people that merely starts with what was typed beats a hamlet of
+# a hundred people with exactly that name.
+POPULATION = 0.5
+
+# Places right where the map is looking are worth this much more, and places
+# NEAR kilometres away are worth half as much more.
+NEARBY = 1.5
+NEAR = 500
+
+# How many of the cheaply scored candidates get looked at more closely.
+SHORTLIST = 4
+
+# Letters that don't decompose into a plain letter and some accents.
+LETTERS = {
+    u'ß': u'ss', u'æ': u'ae', u'œ': u'oe', u'ø': u'o', u'ł': u'l',
+    u'đ': u'd', u'ð': u'd', u'þ': u'th', u'ı': u'i', u'ħ': u'h',
+    u'ŧ': u't', u'ĸ': u'k',
+    
+    # Cyrillic
+    u'а': u'a', u'б': u'b', u'в': u'v', u'г': u'g', u'ґ': u'g',
+    u'д': u'd', u'ђ': u'dj', u'е': u'e', u'є': u'ye', u'ж': u'zh',
+    u'з': u'z', u'ѕ': u'dz', u'и': u'i', u'і': u'i', u'ј': u'j',
+    u'к': u'k', u'л': u'l', u'љ': u'lj', u'м': u'm', u'н': u'n',
+    u'њ': u'nj', u'о': u'o', u'п': u'p', u'р': u'r', u'с': u's',
+    u'т': u't', u'ћ': u'c', u'у': u'u', u'ф': u'f', u'х': u'kh',
+    u'ц': u'ts', u'ч': u'ch', u'џ': u'dz', u'ш': u'sh', u'щ': u'shch',
+    u'ъ': u'', u'ы': u'y', u'ь': u'', u'э': u'e', u'ю': u'yu',
+    u'я': u'ya',
+    
+    # Greek
+    u'α': u'a', u'β': u'v', u'γ': u'g', u'δ': u'd', u'ε': u'e',
+    u'ζ': u'z', u'η': u'i', u'θ': u'th', u'ι': u'i', u'κ': u'k',
+    u'λ': u'l', u'μ': u'm', u'ν': u'n', u'ξ': u'x', u'ο': u'o',
+    u'π': u'p', u'ρ': u'r', u'σ': u's', u'ς': u's', u'τ': u't',
+    u'υ': u'y', u'φ': u'f', u'χ': u'ch', u'ψ': u'ps', u'ω': u'o',
+}
+
+def fold(text):
+    """Turn a name into a search key.
+    
+    The case is folded, accents are removed, and the letters of a few other
+    scripts are transliterated, so that 'sao paulo' finds São Paulo, and
+    'moskva' finds Москва.
+    """
+    if type(text) is str:
+        text = text.decode('utf-8')
+    key = text.lower()
+    try:
+        key.encode('ascii')
+        return key
+    except UnicodeError:
+        pass
+    return u''.join([LETTERS.get(char, char) for char in
+                     normalize('NFKD', key) if not combining(char)])
+
+def trigrams(key):
+    """Return the set of three letter sequences in a key."""
+    return set([key[i:i + 3] for i in xrange(len(key) - 2)])
+
+
+class NameIndex():
+    """A sorted index of city names, built the first time it is needed."""
+    
+    def __init__(self, database):
+        self.database = database
+        self.keys     = None
+        self.ids      = None
+        self.grams    = None
+        self.weights  = None
+        self.vectors  = None
+    
+    def build(self):
+        """Sort the keys, and list which of them each trigram occurs in."""
+        if self.keys is not None:
+            return
+        db = self.database
+        names = sorted([(fold(db.name(i)), i) for i in xrange(len(db))])
+        self.ids = array('I', [i for key, i in names])
+        people = db.populations()
+        self.weights = array('f', [log10(people[i] + 1) * POPULATION
+                                   for key, i in names])
+        lats, lons = db.coordinates()
+        lats = [radians(lats[i]) for key, i in names]
+        lons = [radians(lons[i]) for key, i in names]
+        self.vectors = (
+            array('f', [cos(lat) * cos(lon) for lat, lon in zip(lats, lons)]),
+            array('f', [cos(lat) * sin(lon) for lat, lon in zip(lats, lons)]),
+            array('f', [sin(lat) for lat in lats]))
+        self.grams = {}
+        for position, (key, i) in enumerate(names):
+            for gram in trigrams(key):
+                self.grams.setdefault(gram, array('I')).append(position)
+        self.keys = [key for key, i in names]
+    
+    def prefix(self, key):
+        """Return the range of positions of the keys starting with the key."""
+        self.build()
+        return (bisect_left(self.keys, key),
+                bisect_left(self.keys, key + LAST))
+    
+    def infix(self, key):
+        """Return the positions of the keys containing the key anywhere.
+        
+        The key must be at least three letters long.
+        """
+        self.build()
+        postings = [self.grams.get(gram, ()) for gram in trigrams(key)]
+        keys = self.keys
+        return [position for position in min(postings, key=len)
+                if key in keys[position]]
+    
+    def search(self, text):
+        """Return the numbers of the cities whose names contain the text.
+        
+        The names that start with the text come first, in alphabetical order.
+        """
+        key = fold(text)
+        start, end = self.prefix(key)
+        found = [self.ids[position] for position in xrange(start, end)]
+        if len(key) >= 3:
+            found.extend([self.ids[position] for position in self.infix(key)
+                          if not start <= position < end])
+        return found
+    
+    def quality(self, position, key):
+        """Score how well the key at the given position matches the key."""
+        found = self.keys[position]
+        if found == key:
+            return EXACT
+        if found.startswith(key):
+            return PREFIX
+        if u' ' + key in found or u'-' + key in found:
+            return WORD
+        return INFIX
+    
+    def best(self, text, count=RESULTS, near=None):
+        """Return the numbers of the best few cities matching the text.
+        
+        The cities are scored by how well their names match (see EXACT), how
+        many people live there, and how close they are to near, which is a
+        (lat, lon) pair, if given. They are returned best first.
+        
+        Every candidate is first scored cheaply, assuming that matches in the
+        middle of a name are at the start of a word, and with a single dot
+        product for its distance. Only the best of those get the full score.
+        """
+        key = fold(text)
+        start, end = self.prefix(key)
+        positions = xrange(start, end)
+        if len(key) >= 3:
+            positions = chain(positions, [position for position in
+                self.infix(key) if not start <= position < end])
+        
+        keys, weights = self.keys, self.weights
+        rough = lambda position: (WORD if not start <= position < end else
+                                  EXACT if keys[position] == key else PREFIX)
+        nearby = lambda position: 0
+        if near is not None:
+            lat, lon = radians(near[0]), radians(near[1])
+            x, y, z = cos(lat) * cos(lon), cos(lat) * sin(lon), sin(lat)
+            xs, ys, zs = self.vectors
+            # The squared chord between two unit vectors is 2 - 2 * dot.
+            scale = (NEAR / EARTH_RADIUS) ** 2
+            nearby = lambda position: NEARBY * scale / (scale + 2 - 2 * (
+                xs[position] * x + ys[position] * y + zs[position] * z))
+        
+        shortlist = nlargest(count * SHORTLIST, [(weights[position] +
+            rough(position) + nearby(position), position)
+            for position in positions])
+        scored = nlargest(count, [(score - rough(position) +
+            self.quality(position, key), -position)
+            for score, position in shortlist])
+        return [self.ids[-position] for score, position in scored]
+
+
+index = NameIndex(cities)
@@ -17,12 +17,22 @@
 
 from __future__ import division
 
-from gi.repository import Gtk, Gdk
+from gi.repository import Gtk, Gdk, GLib
+from functools import partial
+from time import time
 
 from common import get_obj, gst, map_view
-from gpsmath import Coordinates, valid_coords
+from gpsmath import Coordinates, valid_coords, distance
+from geocoder import geocoder
 from version import APPNAME
 
+# Update the titlebar at most this often, in seconds.
+TITLE_DELAY = 0.25
+
+# Don't bother looking up the geoname again until the map has moved this many
+# kilometres away from where it was last looked up.
+NEIGHBOURHOOD = 2
+
 def move_by_arrow_keys(accel_group, acceleratable, keyval, modifier):
     """Move the map view by 5% of its length in the given direction."""
     key, view = Gdk.keyval_name(keyval), map_view
@@ -58,13 +68,6 @@ def go_back(button, view):
         gst.reset('history')
     map_view.emit('animation-completed')
 
-def set_window_title(view, set_title, center):
-    """Add the current location we are looking at into the titlebar."""
-    center.latitude  = view.get_center_latitude()
-    center.longitude = view.get_center_longitude()
-    center.lookup_geoname()
-    set_title('%s - %s' % (APPNAME, center.pretty_geoname()))
-
 def zoom_button_sensitivity(view, signal, in_sensitive, out_sensitive):
     """Ensure zoom buttons are only sensitive when they need to be."""
     zoom = view.get_zoom_level()
@@ -72,6 +75,61 @@ def zoom_button_sensitivity(view, signal, in_sensitive, out_sensitive):
     in_sensitive( view.get_max_zoom_level() != zoom)
 
 
+class WindowTitle():
+    """Add the current location we are looking at into the titlebar.
+    
+    The map emits animation-completed after nearly everything the user does,
+    so the first update is shown right away, and any more that arrive within
+    TITLE_DELAY of it are coalesced into a single update at the end of the
+    delay. The geoname is looked up by the geocoder, so the main loop never
+    waits on it, and it isn't looked up at all while the map is still within
+    NEIGHBOURHOOD of where it was last time.
+    """
+    
+    def __init__(self, set_title):
+        self.set_title = set_title
+        self.center    = Coordinates()
+        self.last      = None
+        self.waiting   = None
+        self.pending   = None
+        self.shown     = 0
+    
+    def schedule(self, view):
+        """Update the title now, or soon if it was updated very recently."""
+        if self.pending is not None:
+            return
+        delay = TITLE_DELAY - (time() - self.shown)
+        if delay <= 0 or not geocoder.threaded:
+            self.update(view)
+        else:
+            self.pending = GLib.timeout_add(int(delay * 1000), self.update, view)
+    
+    def update(self, view):
+        """Look up the geoname at the centre of the map, if it has moved."""
+        self.pending = None
+        self.shown   = time()
+        lat = view.get_center_latitude()
+        lon = view.get_center_longitude()
+        if not valid_coords(lat, lon):
+            return False
+        if self.last and distance(lat, lon, *self.last) < NEIGHBOURHOOD:
+            return False
+        self.last = (lat, lon)
+        self.waiting = Coordinates.geodata.key(lat, lon)
+        geocoder.lookup(lat, lon, partial(self.found, self.waiting))
+        return False
+    
+    def found(self, key, data):
+        """Show the geoname, unless the map has moved on since it was asked."""
+        if key != self.waiting:
+            return
+        self.waiting = None
+        if data is None:
+            return
+        self.center.set_geodata(data)
+        self.set_title('%s - %s' % (APPNAME, self.center.pretty_geoname()))
+
+
 class NavigationController():
     """Controls how users navigate the map."""
     
@@ -98,7 +156,7 @@ class NavigationController():
         map_view.connect('notify::zoom-level', zoom_button_sensitivity,
             zoom_in_button.set_sensitive, zoom_out_button.set_sensitive)
         map_view.connect('realize', remember_location)
-        map_view.connect('animation-completed', set_window_title,
-            window.set_title, Coordinates())
+        self.title = WindowTitle(window.set_title)
+        map_view.connect('animation-completed', self.title.schedule)
         map_view.emit('animation-completed')
 
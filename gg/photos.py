@@ -17,22 +17,31 @@
 
 from __future__ import division
 
-from gi.repository import Gio, GObject, GdkPixbuf
+from gi.repository import Gio, GdkPixbuf
 from pyexiv2 import ImageMetadata
-from time import mktime
+from gettext import gettext as _
+from calendar import timegm
 from os import stat
 
 from camera import get_camera
-from common import photos, modified, get_obj
+from common import photos, modified, batch, timestamps, get_obj
 from common import auto_timestamp_comparison
 from gpsmath import Coordinates, float_to_rational
 from gpsmath import dms_to_decimal, decimal_to_dms
 from territories import get_state, get_country
+from thumbnails import thumbnail
 
 # Prefixes for common EXIF keys.
 GPS  = 'Exif.GPSInfo.GPS'
 IPTC = 'Iptc.Application2.'
 
+# Coordinates closer together than this (in degrees, roughly one centimetre)
+# are considered to be the same place.
+EPSILON = 1e-7
+
+# Elevations closer together than this (in metres) are considered the same.
+CLIMB_EPSILON = 0.01
+
 
 class Photograph(Coordinates):
     """Represents a single photograph and it's location in space and time."""
@@ -48,38 +57,69 @@ class Photograph(Coordinates):
         self.manual   = None
         self.camera   = None
         self.iter     = None
+        self.locating = None
+        self.placed   = False
+        self.local_time = None
     
-    def read(self):
-        """Load exif data from disk."""
-        self.exif      = ImageMetadata(self.filename)
-        self.timestamp = None
-        self.altitude  = None
-        self.latitude  = None
-        self.longitude = None
-        self.timezone  = None
-        self.manual    = False
+    def load(self):
+        """Read the EXIF data and a thumbnail from disk.
+        
+        This is the slow part of reading a photo, and it doesn't touch this
+        Photograph or anything else that is shared, so it's safe to call from
+        a worker thread. Returns (exif, local_time, thumb), or raises IOError
+        if the file is not a photograph.
+        """
+        exif = ImageMetadata(self.filename)
         try:
-            self.exif.read()
+            exif.read()
         except TypeError:
             raise IOError
         
-        self.camera = get_camera(self)
-        
-        # Try to get a thumbnail.
+        # Seconds since the epoch, but in the camera's own timezone.
         try:
-            self.thumb = GdkPixbuf.Pixbuf.new_from_file_at_size(
-                    self.filename, self.thm_size, self.thm_size)
-        except GObject.GError:
-            if len(self.exif.previews) > 0:
-                data = self.exif.previews[-1].data
-            elif len(self.exif.exif_thumbnail.data) > 0:
-                data = self.exif.exif_thumbnail.data
+            local_time = timegm(
+                exif['Exif.Photo.DateTimeOriginal'].value.timetuple())
+        except KeyError:
+            local_time = None
+        
+        def preview(size):
+            """Decode a thumbnail from a preview embedded in the photo."""
+            if len(exif.previews) > 0:
+                data = exif.previews[-1].data
+            elif len(exif.exif_thumbnail.data) > 0:
+                data = exif.exif_thumbnail.data
             else:
                 raise IOError
             
-            self.thumb = GdkPixbuf.Pixbuf.new_from_stream_at_scale(
+            return GdkPixbuf.Pixbuf.new_from_stream_at_scale(
                 Gio.MemoryInputStream.new_from_data(data, None),
-                self.thm_size, self.thm_size, True, None)
+                size, size, True, None)
+        
+        # Try the thumbnail cache before decoding anything.
+        thumb = thumbnail(self.filename, self.thm_size, preview)
+        
+        return exif, local_time, thumb
+    
+    def read(self, loaded=None):
+        """Load exif data from disk.
+        
+        If load() has already been called (eg, on a worker thread, see
+        GottenGeography.open_files), pass in what it returned.
+        """
+        exif, local_time, thumb = loaded or self.load()
+        self.exif       = exif
+        self.local_time = local_time
+        self.thumb      = thumb
+        self.timestamp  = None
+        self.altitude   = None
+        self.latitude   = None
+        self.longitude  = None
+        self.timezone   = None
+        self.manual     = False
+        self.locating   = None
+        self.placed     = False
+        
+        self.camera = get_camera(self)
         
         # If we're reloading, then hide the label and clear the ListStore,
         # but if we're loading afresh then we'll need a new iter...
@@ -110,20 +150,22 @@ class Photograph(Coordinates):
         except KeyError:
             pass
     
-    def calculate_timestamp(self):
-        """Determine the timestamp based on the currently selected timezone.
+    def calculate_timestamp(self, utc=None):
+        """Determine the timestamp based on the camera's timezone.
         
-        This method relies on the TZ environment variable to be set before
-        it is called. If you don't set TZ before calling this method, then it
-        implicitely assumes that the camera and the computer are set to the
-        same timezone.
+        The utc argument is the local time already converted into UTC, for
+        when the camera has converted all of its photos at once. Photos
+        without an EXIF timestamp use the file's modification time instead,
+        which is already in UTC.
         """
-        try:
-            self.timestamp = int(mktime(
-                self.exif['Exif.Photo.DateTimeOriginal'].value.timetuple()))
-        except KeyError:
+        if self.local_time is None:
             self.timestamp = int(stat(self.filename).st_mtime)
+        elif utc is None:
+            self.timestamp = self.camera.timezone.to_utc(self.local_time)
+        else:
+            self.timestamp = utc
         self.timestamp += self.camera.get_offset()
+        timestamps.update(self)
         if self.label is not None:
             auto_timestamp_comparison(self)
     
@@ -142,14 +184,28 @@ class Photograph(Coordinates):
         self.liststore.set_value(self.iter, 1, self.long_summary())
     
     def set_location(self, lat, lon, ele=None):
-        """Alter the coordinates of this photo."""
-        if ele is not None:
+        """Alter the coordinates of this photo.
+        
+        Does nothing if the photo is already at the given location, so that
+        recalculating every photo (eg, after a timezone change) only costs
+        anything for the photos that actually moved. Photos whose label has
+        never been placed on the map count as moved, even if their EXIF data
+        already had them there. Updating the label, geoname, and summary is
+        left to the LocationBatch.
+        """
+        moved = not (self.placed and self.valid_coords() and
+                     abs(self.latitude  - lat) < EPSILON and
+                     abs(self.longitude - lon) < EPSILON)
+        climbed = ele is not None and (self.altitude is None or
+            abs(self.altitude - ele) >= CLIMB_EPSILON)
+        if not (moved or climbed):
+            return
+        if climbed:
             self.altitude = ele
-        self.latitude  = lat
-        self.longitude = lon
-        self.position_label()
-        self.lookup_geoname()
-        self.modify_summary()
+        if moved:
+            self.latitude  = lat
+            self.longitude = lon
+        batch.add(self, moved)
     
     def modify_summary(self):
         """Update the text displayed in the GtkListStore."""
@@ -161,7 +217,8 @@ class Photograph(Coordinates):
         """Maintain correct position and visibility of ChamplainLabel."""
         if self.label.get_parent() is None:
             return
-        if self.valid_coords():
+        self.placed = self.valid_coords()
+        if self.placed:
             self.label.set_location(self.latitude, self.longitude)
             self.label.show()
             if self.label.get_selected():
@@ -188,8 +245,27 @@ class Photograph(Coordinates):
         self.timezone                     = tz.strip()
         self.camera.set_found_timezone(self.timezone)
     
+    def geodata_found(self, key, data):
+        """Apply geodata that was looked up for the given location.
+        
+        Answers for places that the photo has since moved away from are
+        ignored, and failed searches answer None, which leaves the geoname
+        as it was. Answers that arrive from the background are a
+        modification of their own, which the batch applies to the
+        GtkListStore.
+        """
+        if key != self.locating:
+            return
+        self.locating = None
+        if data is not None:
+            self.set_geodata(data)
+        if batch.depth == 0:
+            batch.add(self, moved=False)
+    
     def pretty_geoname(self):
         """Override Coordinates.pretty_geoname to read from IPTC."""
+        if self.locating is not None:
+            return _('Locating...')
         names = []
         for key in [ 'City', 'ProvinceState', 'CountryName' ]:
             try: names.extend(self.exif[IPTC + key].values)
@@ -198,9 +274,12 @@ class Photograph(Coordinates):
     
     def destroy(self):
         """Agony!"""
+        self.locating = None
         self.label.unmap()
         self.label.destroy()
         self.camera.photos.discard(self)
+        batch.discard(self)
+        timestamps.discard(self)
         del photos[self.filename]
         modified.discard(self)
         self.liststore.remove(self.iter)
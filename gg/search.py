@@ -13,18 +13,105 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-"""Control how the map is searched."""
+"""Control how the map is searched.
+
+Searches are made on a worker thread, so that typing never has to wait for
+the name index to be built or searched. A search only starts once the user
+has stopped typing for SEARCH_DELAY milliseconds, and a newer search cancels
+any older ones that haven't finished yet. Until the main loop is running,
+searches are synchronous, same as the geocoder.
+"""
 
 from __future__ import division
 
-from os.path import join
+from gi.repository import GLib
+from threading import Thread
+from Queue import Queue, Empty
+from functools import partial
 
 from territories import get_state, get_country
 from common import get_obj, map_view
-from build_info import PKG_DATA_DIR
+from cities import cities
+from nameindex import index, fold
 
 # ListStore column names
-LOCATION, LATITUDE, LONGITUDE = range(3)
+LOCATION, LATITUDE, LONGITUDE, KEY = range(4)
+
+# Wait this long after the last keystroke before searching.
+SEARCH_DELAY = 150
+
+def find(text, near=None):
+    """Return the ListStore rows of the best matches for the text.
+    
+    Places close to near, a (lat, lon) pair, are preferred.
+    """
+    found = []
+    for i in index.best(text, near=near):
+        city, state, country, tz = cities.city(i)
+        lat, lon = cities.location(i)
+        location = ', '.join([s for s in [city,
+                                          get_state(country, state),
+                                          get_country(country)] if s])
+        found.append([location, lat, lon, fold(location).encode('utf-8')])
+    return found
+
+
+class Searcher():
+    """Search for cities on a worker thread."""
+    
+    def __init__(self):
+        self.threaded = False
+        self.requests = Queue()
+        self.latest   = 0
+        self.pending  = None
+        self.worker   = None
+    
+    def search(self, text, near, callback):
+        """Pass the rows of the best matches for the text to the callback.
+        
+        Any earlier searches that haven't finished yet are cancelled.
+        """
+        self.latest += 1
+        if self.pending is not None:
+            GLib.source_remove(self.pending)
+            self.pending = None
+        if not self.threaded:
+            callback(find(text, near))
+            return
+        self.pending = GLib.timeout_add(SEARCH_DELAY, self.start,
+                                        self.latest, text, near, callback)
+    
+    def start(self, number, text, near, callback):
+        """Hand a search over to the worker thread, once typing has paused."""
+        self.pending = None
+        self.requests.put((number, text, near, callback))
+        if self.worker is None:
+            self.worker = Thread(target=self.work, name='searcher')
+            self.worker.daemon = True
+            self.worker.start()
+        return False
+    
+    def work(self):
+        """Search forever, skipping any searches that were cancelled."""
+        while True:
+            request = self.requests.get()
+            try:
+                while True:
+                    request = self.requests.get_nowait()
+            except Empty:
+                pass
+            number, text, near, callback = request
+            if number == self.latest:
+                GLib.idle_add(self.deliver, number, callback, find(text, near))
+    
+    def deliver(self, number, callback, found):
+        """Pass the results along in the main thread, unless cancelled."""
+        if number == self.latest:
+            callback(found)
+        return False
+
+
+searcher = Searcher()
 
 
 class SearchController():
@@ -38,50 +125,54 @@ class SearchController():
         self.slide_to = map_view.go_to
         search = get_obj('search_completion')
         search.set_match_func(
-            lambda c, s, itr, get:
-                (get(itr, LOCATION) or '').lower().find(self.search) > -1,
+            lambda c, s, itr, get: (get(itr, KEY) or '').find(self.search) > -1,
             self.results.get_value)
         search.connect('match-selected', self.search_completed, map_view)
+        self.completion = search
         entry = get_obj('search_box')
-        entry.connect('changed', self.load_results, self.results.append)
+        entry.connect('changed', self.load_results, self.results)
         entry.connect('icon-release', lambda entry, i, e: entry.set_text(''))
-        entry.connect('activate', self.repeat_last_search,
-                      self.results, map_view)
+        entry.connect('activate', self.repeat_last_search, map_view)
     
-    def load_results(self, entry, append, searched=set()):
-        """Load a few search results based on what's been typed.
+    def load_results(self, entry, results):
+        """Load the best few search results for what's been typed.
         
-        Requires at least three letters typed, and is careful not to load
-        duplicate results.
+        Requires at least three letters typed. The results replace whatever
+        was loaded before, so the ListStore only ever holds the best few
+        matches for the current search (see NameIndex.best), and matching
+        costs the same no matter how much has been searched for already.
+        Places near wherever the map is looking come first. The results are
+        loaded in the background, see Searcher.
         
-        The searched argument persists across calls to this method, and should
-        not be passed as an argument unless your intention is to trigger the
-        loading of duplicate results.
+        Each result is stored along with its search key, so that matching it
+        against what's typed doesn't need to fold it again on every keystroke.
         """
-        self.search = entry.get_text().lower()
-        three = self.search[0:3]
-        if len(three) == 3 and three not in searched:
-            searched.add(three)
-            with open(join(PKG_DATA_DIR, 'cities.txt')) as cities:
-                for line in cities:
-                    city, lat, lon, country, state = line.split('\t')[0:5]
-                    if city.lower().find(three) > -1:
-                        append([
-                            ', '.join([s for s in [city,
-                                                   get_state(country, state),
-                                                   get_country(country)] if s]),
-                            float(lat),
-                            float(lon)])
+        key = fold(entry.get_text())
+        self.search = key.encode('utf-8')
+        if len(key) >= 3:
+            searcher.search(key, (map_view.get_center_latitude(),
+                                  map_view.get_center_longitude()),
+                            partial(self.show_results, results))
+    
+    def show_results(self, results, found):
+        """Replace the contents of the ListStore with new search results."""
+        results.clear()
+        for row in found:
+            results.append(row)
+        self.completion.complete()
     
     def search_completed(self, entry, model, itr, view):
         """Go to the selected location."""
-        self.last_search = itr.copy()
-        map_view.emit('realize')
-        view.set_zoom_level(11)
-        self.slide_to(*model.get(itr, LATITUDE, LONGITUDE))
+        self.last_search = model.get(itr, LATITUDE, LONGITUDE)
+        self.go_to(view, *self.last_search)
     
-    def repeat_last_search(self, entry, model, view):
+    def repeat_last_search(self, entry, view):
         """Snap back to the last-searched location when user hits enter key."""
         if self.last_search is not None:
-            self.search_completed(entry, model, self.last_search, view)
-
+            self.go_to(view, *self.last_search)
+    
+    def go_to(self, view, lat, lon):
+        """Zoom in on a location."""
+        map_view.emit('realize')
+        view.set_zoom_level(11)
+        self.slide_to(lat, lon)
@@ -0,0 +1,308 @@
+# Copyright (C) 2012 Robert Park <rbpark@exolucere.ca>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Hold the points of a single GPS track segment while it's being loaded.
+
+Points are accumulated into parallel arrays while the track file is being
+parsed, and then each segment is cleaned up as a whole before any of it gets
+drawn on the map. Compared to a list of objects, the arrays are compact and
+quick to walk over, which matters for tracks with millions of points.
+"""
+
+from __future__ import division
+
+from itertools import izip
+from bisect import bisect
+from array import array
+from math import isnan, cos, radians
+
+from gpsmath import distance, EARTH_RADIUS
+from fusion import DEFAULT_DOP
+
+# Anything faster than the speed of sound (in m/s) is a GPS error,
+# unless you're geotagging photos from the Concorde.
+MAX_SPEED = 343
+
+# Roughly five g, in m/s^2. Enough to allow for noisy but genuine points.
+MAX_ACCEL = 50
+
+# How far ahead to look for the track to return to sanity after a spike.
+LOOKAHEAD = 5
+
+# Typical error of a consumer GPS position, in metres.
+GPS_NOISE = 10
+
+# How hard we expect the GPS to be accelerating at any given time, in m/s^2.
+ACCEL_NOISE = 1
+
+# Slower than this (in m/s) is just GPS noise while standing still.
+MOVING_SPEED = 0.5
+
+# Conversion factor from degrees of latitude to metres.
+METRES_PER_DEGREE = radians(EARTH_RADIUS * 1000)
+
+def rts_smooth(times, values, measured=GPS_NOISE ** 2, process=ACCEL_NOISE ** 2):
+    """Smooth a series of positions along one axis, in metres.
+    
+    This is a constant velocity Kalman filter run forwards through the
+    series, followed by a Rauch-Tung-Striebel smoother run backwards. Both
+    passes are linear in the number of points. The state is a position and
+    a velocity, and the 2x2 covariance matrices are symmetric, so they are
+    kept as three plain floats (a, b, c) = [[a, b], [b, c]] instead of doing
+    any actual matrix math.
+    """
+    total = len(values)
+    if total < 2:
+        return array('d', values)
+    
+    # Everything the backwards pass needs from the forwards pass.
+    fp, fv, fa, fb, fc = [array('d', [0.0]) * total for i in range(5)]
+    pp, pv, pa, pb, pc = [array('d', [0.0]) * total for i in range(5)]
+    
+    # Start off knowing where we are, but not how fast we're going.
+    p, v, a, b, c = values[0], 0.0, measured, 0.0, 100.0
+    fp[0], fv[0], fa[0], fb[0], fc[0] = p, v, a, b, c
+    pp[0], pv[0], pa[0], pb[0], pc[0] = p, v, a, b, c
+    
+    for k in xrange(1, total):
+        # Predict where we should be now.
+        dt = max(times[k] - times[k - 1], 0)
+        p += v * dt
+        a += dt * (2 * b + dt * c) + process * dt ** 3 / 3
+        b += dt * c + process * dt ** 2 / 2
+        c += process * dt
+        pp[k], pv[k], pa[k], pb[k], pc[k] = p, v, a, b, c
+        
+        # Correct that prediction with what was measured.
+        gain_p = a / (a + measured)
+        gain_v = b / (a + measured)
+        error = values[k] - p
+        p += gain_p * error
+        v += gain_v * error
+        c -= gain_v * b
+        a, b = (1 - gain_p) * a, (1 - gain_p) * b
+        fp[k], fv[k], fa[k], fb[k], fc[k] = p, v, a, b, c
+    
+    smoothed = array('d', fp)
+    sp, sv = fp[-1], fv[-1]
+    for k in xrange(total - 2, -1, -1):
+        dt = max(times[k + 1] - times[k], 0)
+        # Gain = P(k) * F' * inverse(predicted P(k+1))
+        m00, m01 = fa[k] + fb[k] * dt, fb[k]
+        m10, m11 = fb[k] + fc[k] * dt, fc[k]
+        a, b, c = pa[k + 1], pb[k + 1], pc[k + 1]
+        det = a * c - b * b
+        if det <= 0:
+            sp, sv = fp[k], fv[k]
+            smoothed[k] = sp
+            continue
+        dp = sp - pp[k + 1]
+        dv = sv - pv[k + 1]
+        sp = fp[k] + ((m00 * c - m01 * b) * dp + (m01 * a - m00 * b) * dv) / det
+        sv = fv[k] + ((m10 * c - m11 * b) * dp + (m11 * a - m10 * b) * dv) / det
+        smoothed[k] = sp
+    return smoothed
+
+
+class Segment():
+    """Parallel arrays of timestamps, latitudes, longitudes, and elevations.
+    
+    There is also an array of the dilution of precision of each point, which
+    is used to decide between devices that were logging at the same time.
+    
+    Elevations that weren't recorded are stored as NaN until they get filled
+    in by fill_elevations(). The smoothed coordinates are empty until
+    smooth() is called, and after that they are kept alongside the raw ones.
+    Likewise the cumulative distance and climb arrays are filled in by
+    measure(), after which questions about distance and speed at any
+    moment can be answered without walking the track again.
+    """
+    
+    def __init__(self):
+        self.times = array('l')
+        self.lats  = array('d')
+        self.lons  = array('d')
+        self.eles  = array('d')
+        self.dops  = array('d')
+        self.smooth_lats = array('d')
+        self.smooth_lons = array('d')
+        self.distances   = array('d')
+        self.climbs      = array('d')
+        self.moving_time = 0
+        self.max_speed   = 0.0
+    
+    def __len__(self):
+        return len(self.times)
+    
+    def __iter__(self):
+        return izip(self.times, self.lats, self.lons, self.eles)
+    
+    def append(self, timestamp, lat, lon, ele=None, dop=DEFAULT_DOP):
+        """Add a point to the end of the segment."""
+        self.times.append(timestamp)
+        self.lats.append(lat)
+        self.lons.append(lon)
+        self.eles.append(float('nan') if ele is None else ele)
+        self.dops.append(dop)
+    
+    def keep(self, indices):
+        """Discard all points except the ones at the given indices."""
+        for name in ('times', 'lats', 'lons', 'eles', 'dops'):
+            old = getattr(self, name)
+            setattr(self, name, array(old.typecode, [old[i] for i in indices]))
+    
+    def speed(self, i, j):
+        """Return the speed in m/s between points i and j.
+        
+        Returns None if the timestamps don't move forward, because there's
+        no way to judge those points.
+        """
+        dt = self.times[j] - self.times[i]
+        if dt <= 0:
+            return None
+        return distance(self.lats[i], self.lons[i],
+                        self.lats[j], self.lons[j]) * 1000 / dt
+    
+    def plausible(self, i, j, before=None):
+        """Decide whether it's physically possible to go from point i to j.
+        
+        The before argument is the speed that we were travelling at when we
+        arrived at point i, if known, and is used to check acceleration.
+        """
+        speed = self.speed(i, j)
+        if speed is None:
+            return True
+        if speed > MAX_SPEED:
+            return False
+        if before is not None:
+            return (speed - before) / (self.times[j] - self.times[i]) <= MAX_ACCEL
+        return True
+    
+    def filter_outliers(self):
+        """Remove points that are too far away to have been reached in time.
+        
+        Cheap GPS loggers occasionally record a point kilometres away from
+        where they really are, and then jump right back. A point is only
+        considered an outlier if it's impossible to reach from the last good
+        point, but one of the next few points is possible to reach, so that
+        genuine jumps (eg, the logger was off for a while) survive.
+        
+        This is a single pass over the points, and returns the number of
+        points that were removed.
+        """
+        total = len(self)
+        if total < 3:
+            return 0
+        
+        # Find a trustworthy point to start from.
+        start = 0
+        for i in xrange(min(LOOKAHEAD, total - 2)):
+            if self.plausible(i, i + 1) and self.plausible(i + 1, i + 2):
+                start = i
+                break
+        
+        keep, before = [start], None
+        for i in xrange(start + 1, total):
+            last = keep[-1]
+            if not self.plausible(last, i, before):
+                ahead = xrange(i + 1, min(i + 1 + LOOKAHEAD, total))
+                if not ahead or any(self.plausible(last, j, before)
+                                    for j in ahead):
+                    continue
+            before = self.speed(last, i)
+            keep.append(i)
+        
+        if len(keep) < total:
+            self.keep(keep)
+        return total - len(keep)
+    
+    def fill_elevations(self, dem):
+        """Fill in missing elevations from elevation tiles, or sea level."""
+        missing = [i for i, ele in enumerate(self.eles) if isnan(ele)]
+        found = dem.elevations([self.lats[i] for i in missing],
+                               [self.lons[i] for i in missing])
+        for i, ele in izip(missing, found):
+            self.eles[i] = 0.0 if ele is None else ele
+    
+    def smooth(self):
+        """Calculate a smoothed copy of the track coordinates.
+        
+        The coordinates are projected onto a flat plane (in metres) around
+        the first point, smoothed, and then projected back into degrees.
+        """
+        if len(self) == 0:
+            return
+        lat0, lon0 = self.lats[0], self.lons[0]
+        scale = METRES_PER_DEGREE * max(cos(radians(lat0)), 0.01)
+        ys = rts_smooth(self.times,
+            [(lat - lat0) * METRES_PER_DEGREE for lat in self.lats])
+        xs = rts_smooth(self.times,
+            [(lon - lon0) * scale for lon in self.lons])
+        self.smooth_lats = array('d', [lat0 + y / METRES_PER_DEGREE for y in ys])
+        self.smooth_lons = array('d', [lon0 + x / scale for x in xs])
+    
+    def measure(self, travelled=0.0, climbed=0.0, smooth=False):
+        """Accumulate the distance travelled and elevation gained.
+        
+        The travelled and climbed arguments are the totals from any previous
+        segments of the same track, so the cumulative arrays continue on
+        from where the last segment left off. If smooth is True, the smoothed
+        coordinates are measured instead, see smooth(). Returns the new
+        totals.
+        """
+        lats = self.smooth_lats if smooth else self.lats
+        lons = self.smooth_lons if smooth else self.lons
+        times, eles = self.times, self.eles
+        self.distances = distances = array('d', [travelled]) * len(self)
+        self.climbs    = climbs    = array('d', [climbed])   * len(self)
+        self.moving_time = 0
+        self.max_speed   = 0.0
+        for i in xrange(1, len(self)):
+            step = distance(lats[i - 1], lons[i - 1], lats[i], lons[i]) * 1000
+            distances[i] = distances[i - 1] + step
+            climbs[i]    = climbs[i - 1] + max(eles[i] - eles[i - 1], 0)
+            dt = times[i] - times[i - 1]
+            if dt > 0 and step / dt > MOVING_SPEED:
+                self.moving_time += dt
+                self.max_speed = max(self.max_speed, step / dt)
+        if len(self):
+            return distances[-1], climbs[-1]
+        return travelled, climbed
+    
+    def index(self, timestamp):
+        """Find the leg of the track that contains the given moment.
+        
+        Returns i such that times[i] <= timestamp < times[i+1], clamped
+        so that there's always a point after it.
+        """
+        return min(max(bisect(self.times, timestamp) - 1, 0), len(self) - 2)
+    
+    def distance_at(self, timestamp):
+        """How far (in metres) the track had travelled at the given moment."""
+        if len(self) < 2:
+            return self.distances[0] if self.distances else 0.0
+        i = self.index(timestamp)
+        dt = self.times[i + 1] - self.times[i]
+        ratio = min(max((timestamp - self.times[i]) / dt, 0), 1) if dt else 0
+        return (self.distances[i] +
+                (self.distances[i + 1] - self.distances[i]) * ratio)
+    
+    def speed_at(self, timestamp):
+        """How fast (in m/s) the track was moving at the given moment."""
+        if len(self) < 2:
+            return 0.0
+        i = self.index(timestamp)
+        dt = self.times[i + 1] - self.times[i]
+        return (self.distances[i + 1] - self.distances[i]) / dt if dt else 0.0
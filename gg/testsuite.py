@@ -17,26 +17,46 @@
 
 from __future__ import division
 
-from gi.repository import Gdk, Clutter, Champlain
+from gi.repository import Gtk, Gdk, GdkPixbuf, Clutter, Champlain
 from unittest import TestCase, TextTestRunner, TestLoader
-from os import listdir, system, environ
+from os import listdir, system, environ, utime, stat
 from os.path import join, abspath
 from fractions import Fraction
 from random import random
 from math import floor
-from time import tzset
+from tempfile import mkdtemp
+from shutil import rmtree
+from struct import pack
+from array import array
+from itertools import chain
+from multiprocessing.pool import ThreadPool
+from time import tzset, mktime, gmtime
+from calendar import timegm
 
 import app
 from photos import Photograph
 from common import GSettings, Struct, map_view
-from common import points, photos, selected, modified
+from common import points, photos, selected, modified, batch, timestamps
 from xmlfiles import known_trackfiles, make_clutter_color
-from xmlfiles import Polygon, clear_all_gpx
+from xmlfiles import Polygon, clear_all_gpx, nearest_point
 from gpsmath import decimal_to_dms, dms_to_decimal, float_to_rational
-from gpsmath import Coordinates, valid_coords
-from navigation import move_by_arrow_keys
+from gpsmath import Coordinates, valid_coords, geocode, lookup_geonames
+from gpsmath import GeoCache
+from geostore import GeoStore
+from geocoder import geocoder
+from elevation import ElevationModel
+from cities import CityDatabase, build_database, write_database, cities
+from update_cities import chunks, parse_chunk, same_place, keep
+from nameindex import NameIndex, fold, RESULTS
+from segment import Segment
+from grid import GridIndex
+from fusion import fuse, dilution, DEFAULT_DOP
+from navigation import move_by_arrow_keys, WindowTitle
+from search import LOCATION, KEY, searcher
 from build_info import PKG_DATA_DIR
 from camera import known_cameras
+from timezones import TimeZone, get_zone
+import thumbnails
 from actor import MAP_SOURCES
 from version import PACKAGE
 
@@ -66,6 +86,7 @@ class GottenGeographyTester(TestCase):
         for photo in photos.values():
             gui.labels.layer.remove_marker(photo.label)
         photos.clear()
+        timestamps.clear()
         modified.clear()
         selected.clear()
         gui.liststore.clear()
@@ -125,6 +146,148 @@ class GottenGeographyTester(TestCase):
             self.assertNotEqual(photo.latitude, old[0])
             self.assertNotEqual(photo.longitude, old[1])
     
+    def test_unchanged_location(self):
+        """Make sure that photos only get modified when they actually move."""
+        gui.open_files(DEMOFILES)
+        self.assertEqual(len(modified), 6)
+        modified.clear()
+        for camera in known_cameras.values():
+            camera.set_timezone()
+        self.assertEqual(len(modified), 0)
+        for photo in photos.values():
+            photo.set_location(photo.latitude + 1e-9, photo.longitude)
+            self.assertFalse(photo in modified)
+            photo.set_location(photo.latitude, photo.longitude, 100.0)
+            self.assertTrue(photo in modified)
+            self.assertEqual(photo.altitude, 100.0)
+            modified.discard(photo)
+            photo.set_location(photo.latitude, photo.longitude, 100.0 + 1e-6)
+            self.assertFalse(photo in modified)
+            
+            # Eg, reopened after being saved at its position along the track.
+            photo.label.hide()
+            photo.placed = False
+            photo.set_location(photo.latitude, photo.longitude)
+            self.assertTrue(photo.placed)
+            self.assertTrue(photo.label.get_property('visible'))
+    
+    def test_partial_retagging(self):
+        """Make sure loading a track only re-tags the photos it covers."""
+        gui.open_files(DEMOFILES)
+        ordered = sorted(photos.values(), key=lambda photo: photo.timestamp)
+        self.assertEqual(sorted(timestamps.between(float('-inf'), float('inf')),
+                                key=lambda photo: photo.timestamp), ordered)
+        first, last = ordered[0].timestamp, ordered[-1].timestamp
+        self.assertEqual(timestamps.between(first, first)[0].timestamp, first)
+        self.assertEqual(len(timestamps.between(last + 1, last + 100)), 0)
+        
+        # A track from years earlier doesn't touch any of the demo photos.
+        tmp = mkdtemp()
+        try:
+            gpx = join(tmp, 'unrelated.gpx')
+            with open(gpx, 'w') as unrelated:
+                unrelated.write('<gpx><trk><trkseg>' + ''.join(
+                    ['<trkpt lat="10" lon="%d"><time>2001-01-01T00:0%d:00Z'
+                     '</time></trkpt>' % (i, i) for i in range(5)]) +
+                    '</trkseg></trk></gpx>')
+            modified.clear()
+            before = dict((photo, (photo.latitude, photo.longitude))
+                          for photo in photos.values())
+            gui.open_files([gpx])
+            self.assertEqual(len(modified), 0)
+            known_trackfiles[gpx].destroy()
+            self.assertEqual(len(modified), 0)
+            for photo in photos.values():
+                self.assertEqual((photo.latitude, photo.longitude),
+                                 before[photo])
+        finally:
+            rmtree(tmp)
+        
+        # Closing a photo takes it out of the index.
+        photo = ordered[0]
+        photo.destroy()
+        self.assertFalse(photo in timestamps.between(first, last))
+    
+    def test_location_batch(self):
+        """Make sure that batched relocations are applied when the batch ends."""
+        gui.open_files([f for f in DEMOFILES if f[-3:] != 'gpx'])
+        with batch:
+            for photo in photos.values():
+                photo.set_location(53.5, -113.5)
+                self.assertTrue(photo in modified)
+                self.assertTrue(photo in batch.relocated)
+                self.assertEqual(photo.pretty_geoname(), '')
+            self.assertEqual(len(batch.pending), 6)
+        self.assertEqual(len(batch.pending), 0)
+        for photo in photos.values():
+            self.assertEqual(photo.label.get_latitude(), 53.5)
+            self.assertEqual(photo.label.get_longitude(), -113.5)
+            self.assertEqual(photo.pretty_geoname(), 'Edmonton, Alberta, Canada')
+    
+    def test_geocoder_failure(self):
+        """Make sure failed searches don't leave anything waiting forever."""
+        old, Coordinates.geodata = Coordinates.geodata, GeoCache()
+        try:
+            answers = []
+            key = Coordinates.geodata.key(10, 10)
+            geocoder.waiting[key] = [answers.append]
+            self.assertRaises(IOError, geocoder.fail, {key: (10, 10)}, IOError())
+            self.assertEqual(answers, [None])
+            self.assertFalse(geocoder.waiting)
+            self.assertIsNone(Coordinates.geodata.get(key))
+        finally:
+            Coordinates.geodata = old
+    
+    def test_background_geocoding(self):
+        """Make sure geonames can be looked up without blocking."""
+        gui.open_files([f for f in DEMOFILES if f[-3:] != 'gpx'])
+        old, Coordinates.geodata = Coordinates.geodata, GeoCache()
+        geocoder.threaded = True
+        try:
+            with batch:
+                for photo in photos.values():
+                    photo.set_location(51.05, -114.08)
+            
+            # Every photo is waiting on the same place, which is searched once.
+            key = Coordinates.geodata.key(51.05, -114.08)
+            self.assertEqual(len(geocoder.waiting[key]), 6)
+            for photo in photos.values():
+                self.assertEqual(photo.pretty_geoname(), 'Locating...')
+            
+            for i in range(1000):
+                if not geocoder.waiting:
+                    break
+                Gtk.main_iteration_do(True)
+            self.assertFalse(geocoder.waiting)
+            self.assertEqual(Coordinates.geodata.misses, 1)
+            for photo in photos.values():
+                self.assertIsNone(photo.locating)
+                self.assertEqual(photo.pretty_geoname(),
+                                 'Calgary, Alberta, Canada')
+            
+            # Answers for places a photo has already left are ignored.
+            photo = photos.values()[0]
+            photo.set_location(53.5, -113.5)
+            photo.set_location(51.05, -114.08)
+            self.assertIsNone(photo.locating)
+            for i in range(1000):
+                if not geocoder.waiting:
+                    break
+                Gtk.main_iteration_do(True)
+            self.assertEqual(photo.pretty_geoname(), 'Calgary, Alberta, Canada')
+            
+            # Nor are answers for photos that have been closed.
+            photo.set_location(53.5, -113.5)
+            photo.destroy()
+            for i in range(1000):
+                if not geocoder.waiting:
+                    break
+                Gtk.main_iteration_do(True)
+            self.assertFalse(photo in modified)
+        finally:
+            geocoder.threaded = False
+            Coordinates.geodata = old
+    
     def test_label_controller(self):
         """Make sure that ChamplainLabels are behaving."""
         gui.open_files(DEMOFILES)
@@ -179,6 +342,80 @@ class GottenGeographyTester(TestCase):
         map_view.set_map_source(MAP_SOURCES['osm-cyclemap'])
         self.assertEqual(app.gst.get_string('map-source-id'), 'osm-cyclemap')
     
+    def test_threaded_loading(self):
+        """Photos are read on worker threads and handed back in order."""
+        pool = ThreadPool(2)
+        files = DEMOFILES * 3
+        ready = list(chain(*app.batches(pool.imap(app.load_photo, files),
+                                        len(files))))
+        pool.close()
+        self.assertEqual(len(ready), len(files))
+        for filename, loaded in zip(files, ready):
+            if filename.endswith('.gpx'):
+                self.assertIsNone(loaded)
+                continue
+            exif, local_time, thumb = loaded
+            self.assertEqual(exif.filename, filename)
+            self.assertGreater(local_time, 0)
+            self.assertEqual(max(thumb.get_width(), thumb.get_height()), 200)
+        
+        # The photos opened through the pool are read the same as ever.
+        jpegs = [f for f in DEMOFILES if f[-3:] != 'gpx']
+        gui.open_files(jpegs)
+        self.assertEqual(len(photos), len(jpegs))
+        self.assertEqual(len(modified), 0)
+        for photo in photos.values():
+            exif, local_time, thumb = app.load_photo(photo.filename)
+            self.assertEqual(photo.local_time, local_time)
+            self.assertIsNotNone(photo.camera)
+            self.assertIsNotNone(photo.iter)
+    
+    def test_thumbnail_cache(self):
+        """Thumbnails are shared through the freedesktop.org cache."""
+        jpeg = [f for f in DEMOFILES if f[-3:] != 'gpx'][0]
+        old, thumbnails.CACHE = thumbnails.CACHE, mkdtemp()
+        mtime = stat(jpeg).st_mtime
+        try:
+            thumb = Photograph(jpeg).load()[2]
+            self.assertEqual(max(thumb.get_width(), thumb.get_height()), 200)
+            files = listdir(join(thumbnails.CACHE, 'large'))
+            self.assertEqual(len(files), 1)
+            cached = GdkPixbuf.Pixbuf.new_from_file(
+                join(thumbnails.CACHE, 'large', files[0]))
+            self.assertEqual(max(cached.get_width(), cached.get_height()), 256)
+            self.assertEqual(cached.get_option(thumbnails.URI),
+                             'file://' + jpeg)
+            self.assertEqual(cached.get_option(thumbnails.MTIME),
+                             str(int(mtime)))
+            
+            # Cached thumbnails are used without decoding the photo again.
+            def fail(size):
+                raise AssertionError
+            thumb = thumbnails.thumbnail(jpeg, 100, fail)
+            self.assertEqual(max(thumb.get_width(), thumb.get_height()), 100)
+            
+            # But not once the photo has been modified since.
+            utime(jpeg, (0, 0))
+            thumbnails.thumbnail(jpeg, 100, fail)
+            cached = GdkPixbuf.Pixbuf.new_from_file(
+                join(thumbnails.CACHE, 'large', files[0]))
+            self.assertEqual(cached.get_option(thumbnails.MTIME), '0')
+            
+            # Embedded previews and sizes too big for the cache aren't cached.
+            gpx = [f for f in DEMOFILES if f[-3:] == 'gpx'][0]
+            made = []
+            thumb = thumbnails.thumbnail(gpx, 100,
+                lambda size: made.append(size) or cached)
+            self.assertIs(thumb, cached)
+            self.assertEqual(made, [100])
+            thumbnails.thumbnail(jpeg, 2000, fail)
+            self.assertEqual(listdir(thumbnails.CACHE), ['large'])
+            self.assertEqual(len(listdir(join(thumbnails.CACHE, 'large'))), 1)
+        finally:
+            utime(jpeg, (mtime, mtime))
+            rmtree(thumbnails.CACHE)
+            thumbnails.CACHE = old
+    
     def test_camera_offsets(self):
         """Make sure that camera offsets function correctly."""
         gui.open_files([DEMOFILES[1]])
@@ -195,6 +432,34 @@ class GottenGeographyTester(TestCase):
             for i, num in enumerate(start):
                 self.assertEqual(end[i] - num, delta)
     
+    def test_found_timezone(self):
+        """Timezones that are found after the photos are loaded still apply."""
+        gst = GSettings('camera', 'canon_canon_powershot_a590_is')
+        gst.reset('found-timezone')
+        gst.reset('offset')
+        gst.set_string('timezone-method', 'lookup')
+        known_cameras.clear()
+        
+        gui.open_files([f for f in DEMOFILES if f[-3:] != 'gpx'])
+        photo = photos.values()[0]
+        timestamp = photo.timestamp
+        
+        # Eg, the geocoder answering from the background.
+        photo.camera.set_found_timezone('America/Winnipeg')
+        self.assertEqual(photo.timestamp, timestamp - 3600)
+        photo.camera.set_found_timezone('America/Edmonton')
+        self.assertEqual(photo.timestamp, timestamp)
+        
+        # Flipping back and forth (eg, at a border) only retimes once each.
+        photo.camera.set_found_timezone('America/Winnipeg')
+        self.assertEqual(photo.timestamp, timestamp)
+        
+        # Only the lookup method pays attention to it.
+        gst.set_string('timezone-method', 'system')
+        photo.camera.set_found_timezone('America/Halifax')
+        self.assertEqual(photo.timestamp, timestamp)
+        gst.reset('found-timezone')
+    
     def test_timezone_lookups(self):
         """Ensure that the timezone can be discovered from the map."""
         # Be very careful to reset everything so that we're sure that
@@ -226,6 +491,49 @@ class GottenGeographyTester(TestCase):
         self.assertAlmostEqual(photo.latitude, 53.52263, 5)
         self.assertAlmostEqual(photo.longitude, -113.44898, 5)
     
+    def test_timezones(self):
+        """Make sure local times are converted into UTC like mktime does."""
+        try:
+            for name in ('America/Edmonton', 'Europe/London', 'Asia/Kolkata',
+                         'Australia/Sydney', 'America/St_Johns', 'UTC'):
+                zone = get_zone(name)
+                self.assertIs(zone, get_zone(name))
+                environ['TZ'] = name
+                tzset()
+                # Noon, because mktime is inconsistent about ambiguous times.
+                local = [timegm(gmtime(int(random() * 2 ** 31))[:3] +
+                                (12, 0, 0)) for i in range(1000)]
+                for when, utc in zip(local, zone.to_utc_many(local)):
+                    self.assertEqual(utc, zone.to_utc(when))
+                    self.assertEqual(utc, mktime(gmtime(when)[:8] + (-1,)))
+        finally:
+            environ['TZ'] = 'America/Edmonton'
+            tzset()
+        
+        zone = get_zone('America/Edmonton')
+        summer = timegm((2012, 7, 1, 12, 0, 0))
+        winter = timegm((2012, 12, 1, 12, 0, 0))
+        self.assertEqual(zone.to_utc(summer) - summer, 6 * 3600)
+        self.assertEqual(zone.to_utc(winter) - winter, 7 * 3600)
+        
+        # Clocks go forward, and 2:30am doesn't exist.
+        skipped = timegm((2012, 3, 11, 2, 30, 0))
+        self.assertEqual(zone.to_utc(skipped), timegm((2012, 3, 11, 9, 30, 0)))
+        
+        # Clocks go back, and 1:30am happens twice.
+        twice = timegm((2012, 11, 4, 1, 30, 0))
+        self.assertEqual(zone.to_utc(twice), timegm((2012, 11, 4, 7, 30, 0)))
+        
+        # Past the end of the transition table, the POSIX rule takes over.
+        future = timegm((2090, 7, 1, 12, 0, 0))
+        self.assertEqual(zone.to_utc(future) - future, 6 * 3600)
+        rule = TimeZone('MST7MDT,M3.2.0,M11.1.0')
+        self.assertEqual(rule.to_utc(summer) - summer, 6 * 3600)
+        self.assertEqual(rule.to_utc(winter) - winter, 7 * 3600)
+        
+        # Unknown zones are UTC.
+        self.assertEqual(TimeZone('Nowhere/Special').to_utc(summer), summer)
+    
     def test_demo_data(self):
         """Load the demo data and ensure that we're reading it in properly."""
         self.assertEqual(len(points), 0)
@@ -423,6 +731,80 @@ S 10.00000, W 10.00000
         stjohns.lookup_geoname()
         self.assertEqual(stjohns.city, "St. John's")
         
+        # Looking up many coordinates at once gives the same answers.
+        lats = [random_coord(80) for i in range(20)] + [stjohns.latitude]
+        lons = [random_coord(180) for i in range(20)] + [stjohns.longitude]
+        self.assertEqual(geocode(lats, lons),
+                         [cities.city(cities.nearest(lat, lon))
+                          for lat, lon in zip(lats, lons)])
+        others = [Coordinates() for lat in lats]
+        for other, lat, lon in zip(others, lats, lons):
+            other.latitude, other.longitude = lat, lon
+        self.assertEqual(lookup_geonames(others + [Coordinates()]),
+                         [other.lookup_geoname() for other in others])
+        self.assertEqual(others[-1].city, "St. John's")
+        
+        # The geodata cache is bounded and counts what it's doing.
+        cache = GeoCache(2)
+        self.assertEqual(cache.key(53.5449, -113.4939), (5354, -11349))
+        self.assertIsNone(cache.get(cache.key(1, 2)))
+        cache[1, 2] = 'one'
+        cache[3, 4] = 'two'
+        self.assertEqual(cache.get((1, 2)), 'one')
+        cache[5, 6] = 'three'
+        self.assertFalse((3, 4) in cache)
+        self.assertTrue((1, 2) in cache)
+        self.assertEqual((cache.hits, cache.misses, cache.evictions), (1, 1, 1))
+        cache.resize(1)
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.get((5, 6)), 'three')
+        self.assertEqual(cache.evictions, 2)
+        self.assertTrue('2 hits' in cache.stats())
+        
+        # Places can be remembered from one session to the next.
+        tmp = mkdtemp()
+        try:
+            filename = join(tmp, 'cache', 'geodata.sqlite')
+            store = GeoStore(filename, 'one')
+            cache = GeoCache(10, store)
+            cache[1, 2] = ['Edmonton', '01', 'CA', 'America/Edmonton']
+            self.assertEqual(len(store.pending), 1)
+            self.assertIsNotNone(store.timer)
+            
+            # Queued places are written after a while, even if idle.
+            self.assertFalse(store.timeout())
+            self.assertEqual(len(store.pending), 0)
+            self.assertIsNone(store.timer)
+            cache[1, 3] = ['Edmonton', '01', 'CA', 'America/Edmonton']
+            cache.close()
+            self.assertEqual(len(store.pending), 0)
+            self.assertIsNone(store.timer)
+            
+            cache = GeoCache(10, GeoStore(filename, 'one'))
+            self.assertEqual(cache.get((1, 2)),
+                             ['Edmonton', '01', 'CA', 'America/Edmonton'])
+            self.assertEqual(cache.get((1, 2))[0], 'Edmonton')
+            self.assertIsNone(cache.get((3, 4)))
+            self.assertEqual((cache.hits, cache.loads, cache.misses), (1, 1, 1))
+            cache.close()
+            
+            # Rebuilding cities.db invalidates everything.
+            cache = GeoCache(10, GeoStore(filename, 'two'))
+            self.assertIsNone(cache.get((1, 2)))
+            cache.close()
+            
+            # The store can't be written, but the cache still works.
+            cache = GeoCache(10, GeoStore(join(filename, 'nope'), 'one'))
+            cache[5, 6] = ['Calgary', '01', 'CA', 'America/Edmonton']
+            cache.close()
+            self.assertTrue(cache.store.broken)
+            self.assertEqual(cache.get((5, 6))[0], 'Calgary')
+        finally:
+            rmtree(tmp)
+        app.gst.set_int('geodata-cache-size', 5)
+        self.assertEqual(Coordinates.geodata.size, 5)
+        self.assertLessEqual(len(Coordinates.geodata), 5)
+        
         # Pick 100 random coordinates on the globe, convert them from decimal
         # to sexagesimal and then back, and ensure that they are always equal.
         for i in range(100):
@@ -466,6 +848,362 @@ S 10.00000, W 10.00000
                 10 # equal to 10 places
             )
     
+    def test_city_database(self):
+        """Make sure the binary cities database finds the right cities."""
+        tmp = mkdtemp()
+        try:
+            source = join(tmp, 'cities.txt')
+            with open(source, 'w') as cities:
+                cities.write('\n'.join(['\t'.join(row) for row in [
+                    ['Edmonton', '53.55014', '-113.46871', 'CA', '01',
+                     'America/Edmonton'],
+                    ['Calgary', '51.05011', '-114.08529', 'CA', '01',
+                     'America/Edmonton'],
+                    ["St. John's", '47.56494', '-52.70931', 'CA', '05',
+                     'America/St_Johns'],
+                    ['Paris', '48.85341', '2.3488', 'FR', 'A8',
+                     'Europe/Paris', '2138551']]]) + '\n')
+            build_database(source, join(tmp, 'cities.db'))
+            db = CityDatabase(join(tmp, 'cities.db'))
+            self.assertEqual(len(db), 4)
+            
+            # Cities are sorted south to north.
+            self.assertEqual([db.name(i) for i in range(4)],
+                ["St. John's", 'Paris', 'Calgary', 'Edmonton'])
+            self.assertEqual(db.city(db.nearest(53.5, -113.5)),
+                ['Edmonton', '01', 'CA', 'America/Edmonton'])
+            self.assertEqual(db.name(db.nearest(50, -114)), 'Calgary')
+            self.assertEqual(db.name(db.nearest(-45, 170)), 'Calgary')
+            self.assertEqual(db.name(db.nearest(90, 0)), 'Edmonton')
+            self.assertEqual(db.name(db.nearest(-90, 0)), "St. John's")
+            self.assertEqual(db.name(db.nearest(48, 2)), 'Paris')
+            queries = [(53.5, -113.5), (48, 2), (53.5, -113.5), (-90, 0)]
+            self.assertEqual(db.nearest_many(*zip(*queries)),
+                             [db.nearest(lat, lon) for lat, lon in queries])
+            lat, lon = db.location(db.nearest(48, 2))
+            self.assertAlmostEqual(lat, 48.85341, 4)
+            self.assertAlmostEqual(lon, 2.3488, 4)
+            
+            # Interned strings are only stored once.
+            self.assertEqual(db.city(2)[3], db.city(3)[3])
+            self.assertEqual(open(join(tmp, 'cities.db')).read().count(
+                'America/Edmonton'), 1)
+            
+            self.assertRaises(IOError, CityDatabase(source).open)
+            
+            # Old style cities.txt files have no populations, unless they
+            # have a seventh column.
+            self.assertEqual(db.population(0), 0)
+            self.assertEqual(db.population(1), 2138551)
+            self.assertEqual(db.alternates(0), [])
+        finally:
+            rmtree(tmp)
+    
+    def test_update_cities(self):
+        """Make sure the geonames.org dump is filtered properly."""
+        tmp = mkdtemp()
+        try:
+            dump = join(tmp, 'allCountries.txt')
+            rows = [
+                ['Edmonton', 'Edmonton,Amiskwaciy', '53.55014', '-113.46871',
+                 'P', '712391'],
+                ['Edmonton', '', '53.56', '-113.47', 'P', '10'],
+                ['Edmonton', '', '53.61', '-113.52', 'P', '5000'],
+                ['Calgary', 'YYC', '51.05011', '-114.08529', 'P', '1019942'],
+                ['Rocky Mountains', '', '52', '-117', 'T', '0'],
+                ['Nowhere', '', '55', '-115', 'P', ''],
+                ['Unclassified', '', '54', '-114', '', '5000'],
+            ]
+            with open(dump, 'w') as geonames:
+                for i, (name, alternates, lat, lon, kind, people) in enumerate(rows):
+                    geonames.write('\t'.join([str(i), name, name, alternates,
+                        lat, lon, kind, 'PPL', 'CA', '', '01', '', '', '',
+                        people, '', '', 'America/Edmonton', '2012-01-01']) + '\n')
+            
+            # Every line is read exactly once, no matter how it's chunked.
+            for size in (1, 50, 100000):
+                places = []
+                for start, end in chunks(dump, size):
+                    places.extend(parse_chunk((dump, start, end, 1000, 'P')))
+                self.assertEqual(sorted([place[2] for place in places]),
+                                 ['Calgary', 'Edmonton', 'Edmonton'])
+            
+            edmonton = [place for place in places if place[6] == 712391][0]
+            self.assertEqual(edmonton[2:8], ('Edmonton', '01', 'CA',
+                'America/Edmonton', 712391, 'Amiskwaciy'))
+            self.assertEqual(same_place(edmonton), same_place(
+                [place for place in places if place[6] == 5000][0]))
+            self.assertEqual(len(parse_chunk((dump, 0, 1000, 0, 'PT'))), 6)
+            
+            # Duplicates are found on either side of the edge of a cell.
+            kept = {}
+            for lat, people in ((53.549, 10), (53.551, 20), (53.75, 30)):
+                keep(kept, (lat, -113.5, 'Edmonton', '01', 'CA', '', people, ''))
+            self.assertEqual(sorted([place[6] for place in kept.values()]),
+                             [20, 30])
+        finally:
+            rmtree(tmp)
+    
+    def test_name_index(self):
+        """Make sure cities can be found by name without a full scan."""
+        tmp = mkdtemp()
+        try:
+            names = ['Edmonton', 'Edson', 'Red Deer', 'Redwater', 'Medicine Hat',
+                     'St. Albert', 'Stettler', 'Fort Saskatchewan', 'Ed']
+            people = [812201, 8475, 90564, 2202, 60005, 61466, 5748, 19051, 10]
+            build = join(tmp, 'cities.db')
+            write_database([(50, -113 + 10 * i, name, '01', 'CA',
+                             'America/Edmonton', people[i], '')
+                            for i, name in enumerate(names)], build)
+            db = CityDatabase(build)
+            index = NameIndex(db)
+            found = lambda text: [db.name(i) for i in index.search(text)]
+            
+            self.assertEqual(found('ed'), ['Ed', 'Edmonton', 'Edson'])
+            self.assertEqual(found('EDM'), ['Edmonton'])
+            self.assertEqual(found('st'), ['St. Albert', 'Stettler'])
+            self.assertEqual(len(found('')), len(names))
+            
+            # Matches in the middle come after the ones at the start.
+            self.assertEqual(found('red'), ['Red Deer', 'Redwater'])
+            self.assertEqual(found('ed '), ['Red Deer'])
+            self.assertEqual(found('edi'), ['Medicine Hat'])
+            self.assertEqual(found('wat')[0], 'Redwater')
+            self.assertEqual(found('tch'), ['Fort Saskatchewan'])
+            self.assertEqual(found('xyz'), [])
+            
+            # The best matches are the biggest places that start with it.
+            best = lambda text, count: [db.name(i) for i in
+                                        index.best(text, count)]
+            self.assertEqual(best('ed', 2), ['Edmonton', 'Edson'])
+            self.assertEqual(best('ed', 10), ['Edmonton', 'Edson', 'Ed'])
+            self.assertEqual(best('st', 5), ['St. Albert', 'Stettler'])
+            self.assertEqual(best('sas', 1), ['Fort Saskatchewan'])
+            self.assertEqual(best('ed', 0), [])
+            
+            # Unless there's something smaller much closer by.
+            self.assertEqual(best('red', 2), ['Red Deer', 'Redwater'])
+            self.assertEqual([db.name(i) for i in
+                              index.best('red', 2, near=(50, -83))],
+                             ['Redwater', 'Red Deer'])
+            
+            # Accents, case, and scripts are all folded away.
+            self.assertEqual(fold('S\xc3\xa3o Paulo'), 'sao paulo')
+            self.assertEqual(fold(u'\u0141\xf3d\u017a'), 'lodz')
+            self.assertEqual(fold(u'\u041c\u043e\u0441\u043a\u0432\u0430'), 'moskva')
+            self.assertEqual(fold('STRA\xc3\x9fBURG'), 'strassburg')
+            
+            # Every substring of every name is found.
+            for name in names:
+                for i in range(len(name) - 2):
+                    self.assertIn(name, found(name[i:]))
+        finally:
+            rmtree(tmp)
+    
+    def test_elevation_model(self):
+        """Make sure that elevation tiles are read and interpolated correctly."""
+        directory = mkdtemp()
+        with open(join(directory, 'N53W114.hgt'), 'wb') as hgt:
+            # A 3x3 tile, rows from north to south, with one void.
+            hgt.write(pack('>9h', 100, 200, 300,
+                                  400, 500, 600,
+                                  700, 800, -32768))
+        dem = ElevationModel(directory, max_tiles=1)
+        self.assertEqual(dem.elevation(53, -114), 700)
+        self.assertEqual(dem.elevation(53.5, -114), 400)
+        self.assertEqual(dem.elevation(53.5, -113.5), 500)
+        self.assertAlmostEqual(dem.elevation(53.75, -113.75), 300)
+        self.assertAlmostEqual(dem.elevation(53.25, -113.25), 1900 / 3)
+        self.assertIsNone(dem.elevation(10, 10))
+        self.assertEqual(dem.elevations([53.5, 10, 53], [-113.5, 10, -114]),
+                         [500, None, 700])
+        self.assertEqual(len(dem.tiles), 1)
+        rmtree(directory)
+    
+    def test_outlier_filter(self):
+        """Make sure that GPS spikes are removed but genuine jumps survive."""
+        segment = Segment()
+        for i in range(20):
+            segment.append(1000 + i, 53.5 + i * 0.00001, -113.5)
+        segment.lats[5] += 0.05          # 5km away for one second
+        segment.lats[10] += 0.1          # 10km away for two seconds
+        segment.lats[11] += 0.1
+        segment.times[15:] = array('l', [t + 3600 for t in segment.times[15:]])
+        segment.lats[15:] = array('d', [lat + 0.5 for lat in segment.lats[15:]])
+        self.assertEqual(segment.filter_outliers(), 3)
+        self.assertEqual(len(segment), 17)
+        self.assertFalse(1005 in segment.times)
+        self.assertFalse(1010 in segment.times)
+        self.assertTrue(4619 in segment.times)
+        
+        gui.open_files(DEMOFILES)
+        self.assertEqual(known_trackfiles.values()[0].outliers, 0)
+    
+    def test_track_smoothing(self):
+        """Make sure that the smoothed track is closer to the truth."""
+        segment = Segment()
+        truth = [53.5 + i * 0.00003 for i in range(300)]
+        for i, lat in enumerate(truth):
+            segment.append(1000 + i, lat + (random() - 0.5) * 0.0002, -113.5)
+        segment.smooth()
+        self.assertEqual(len(segment.smooth_lats), 300)
+        error = lambda lats: sum([abs(a - b) for a, b in zip(lats, truth)])
+        self.assertLess(error(segment.smooth_lats), error(segment.lats))
+        
+        # Tracks aren't smoothed until smoothing is turned on.
+        gui.open_files(DEMOFILES)
+        gpx = known_trackfiles.values()[0]
+        self.assertFalse(gpx.segments[0].smooth_lats)
+        raw = dict([(p, (p.latitude, p.longitude)) for p in photos.values()])
+        app.gst.set_boolean('smooth-tracks', True)
+        self.assertTrue(gpx.smoothed)
+        self.assertEqual(len(gpx.segments[0].smooth_lats),
+                         len(gpx.segments[0]))
+        for photo in photos.values():
+            self.assertTrue(photo.valid_coords())
+            self.assertAlmostEqual(photo.latitude, raw[photo][0], 3)
+            self.assertAlmostEqual(photo.longitude, raw[photo][1], 3)
+    
+    def test_track_statistics(self):
+        """Make sure that track statistics are measured correctly."""
+        app.gst.set_boolean('smooth-tracks', True)
+        gui.open_files([f for f in DEMOFILES if f[-3:] == 'gpx'])
+        gpx = known_trackfiles.values()[0]
+        self.assertAlmostEqual(gpx.distance, 4423, -1)
+        self.assertAlmostEqual(gpx.climb, 113, 0)
+        self.assertGreater(gpx.moving_time, 900)
+        self.assertLessEqual(gpx.moving_time, gpx.omega - gpx.alpha)
+        self.assertAlmostEqual(gpx.max_speed, 6.4, 1)
+        self.assertEqual(gpx.distance_between(gpx.alpha, gpx.omega),
+                         gpx.distance)
+        self.assertEqual(gpx.distance_between(0, gpx.alpha), 0)
+        middle = (gpx.alpha + gpx.omega) // 2
+        self.assertAlmostEqual(gpx.distance_between(gpx.alpha, middle) +
+                               gpx.distance_between(middle, gpx.omega),
+                               gpx.distance)
+        self.assertGreater(gpx.speed_at(middle), 0)
+        self.assertEqual(gpx.stats.get_text(), gpx.pretty_statistics())
+        
+        # Turning smoothing off measures the raw, noisier track instead.
+        smoothed = gpx.distance
+        app.gst.set_boolean('smooth-tracks', False)
+        self.assertGreater(gpx.distance, smoothed)
+        self.assertEqual(gpx.stats.get_text(), gpx.pretty_statistics())
+        app.gst.set_boolean('smooth-tracks', True)
+        self.assertEqual(gpx.distance, smoothed)
+    
+    def test_reverse_time_lookup(self):
+        """Make sure we can tell when the track went through a location."""
+        self.assertIsNone(nearest_point(53.5, -113.5))
+        gui.open_files(DEMOFILES)
+        for timestamp, point in points.items():
+            dist, when = nearest_point(point.lat, point.lon)
+            self.assertAlmostEqual(dist, 0)
+            self.assertEqual(points[when].lat, point.lat)
+            self.assertEqual(points[when].lon, point.lon)
+        self.assertIsNone(nearest_point(0, 0, 100))
+        self.assertGreater(nearest_point(0, 0)[0], 5000)
+        
+        # Dropping a photo onto the track suggests a clock offset.
+        photo = photos.values()[0]
+        point = points[sorted(points)[len(points) // 2]]
+        photo.label.set_location(point.lat, point.lon)
+        photo.label.emit('drag-finish', Clutter.Event())
+        when = nearest_point(point.lat, point.lon)[1]
+        self.assertEqual(photo.camera.suggest_offset(photo, when),
+                         when - photo.timestamp)
+        self.assertTrue('GPS track suggests' in
+                        photo.camera.offset.get_tooltip_text())
+    
+    def test_grid_index(self):
+        """Make sure the spatial index finds the nearest point."""
+        index = GridIndex()
+        self.assertIsNone(index.nearest(10, 170))
+        index.add(10, 179.999, 'east')
+        index.add(10, 170, 'west')
+        self.assertEqual(index.nearest(10, 171)[1], 'west')
+        
+        # Longitudes wrap around at the antimeridian.
+        dist, value = index.nearest(10, -179.999)
+        self.assertEqual(value, 'east')
+        self.assertAlmostEqual(dist, 0.219, 3)
+        self.assertIsNone(index.nearest(10, -179.999, 0.2))
+        self.assertEqual(index.nearest(10, -179.999, 0.3)[1], 'east')
+    
+    def test_track_fusion(self):
+        """Ensure overlapping devices are merged into a single timeline."""
+        self.assertEqual(dilution('1.5', '8'), 1.5)
+        self.assertEqual(dilution(None, '4'), 2.5)
+        self.assertEqual(dilution(), DEFAULT_DOP)
+        
+        phone  = [(t, 8.0, 'phone')  for t in range(0, 100, 10)]
+        logger = [(t, 1.0, 'logger') for t in range(35, 66, 5)]
+        fused = list(fuse([(0, phone), (0, logger)]))
+        self.assertEqual([t for t, value in fused], sorted(set(
+            [t for t, d, v in phone if not 35 <= t <= 65] +
+            [t for t, d, v in logger])))
+        for timestamp, value in fused:
+            self.assertEqual(value, 'logger' if 35 <= timestamp <= 65
+                                    else 'phone')
+        
+        # Priority beats precision, and long gaps don't count as logging.
+        fused = dict(fuse([(1, phone), (0, logger)]))
+        self.assertEqual(set(fused.values()), set(['phone']))
+        fused = dict(fuse([(0, phone), (0, logger)], max_gap=2))
+        self.assertEqual(fused[40], 'logger')
+        self.assertEqual(fused[50], 'logger')
+        self.assertEqual(fused[45], 'logger')
+        self.assertEqual(len(fused), 14)
+        
+        # Track files feed points through the fused timeline.
+        gui.open_files(DEMOFILES)
+        self.assertEqual(len(points), 374)
+        self.assertEqual(points.stamps, sorted(points))
+        stamp = points.stamps[100]
+        self.assertEqual(points.before(stamp), points.stamps[99])
+        self.assertEqual(points.after(stamp), points.stamps[101])
+        self.assertEqual(points.before(points.stamps[0]), float('-inf'))
+        self.assertEqual(points.after(points.stamps[-1]), float('inf'))
+        for trackfile in known_trackfiles.values():
+            trackfile.destroy()
+            self.assertEqual(points.stamps, sorted(points))
+        self.assertEqual(len(points), 0)
+        self.assertEqual(points.stamps, [])
+    
+    def test_window_title(self):
+        """Make sure the titlebar keeps up without slowing the map down."""
+        titles = []
+        title = WindowTitle(titles.append)
+        map_view.center_on(51.05, -114.08)
+        title.schedule(map_view)
+        self.assertEqual(titles, ['GottenGeography - Calgary, Alberta, Canada'])
+        
+        # Moving a short distance doesn't look anything up again.
+        map_view.center_on(51.051, -114.081)
+        title.schedule(map_view)
+        self.assertAlmostEqual(title.last[0], 51.05, 4)
+        self.assertAlmostEqual(title.last[1], -114.08, 4)
+        
+        geocoder.threaded = True
+        try:
+            # A burst of updates is coalesced into one, after the first.
+            title.shown = 0
+            map_view.center_on(53.55, -113.47)
+            title.schedule(map_view)
+            self.assertIsNotNone(title.waiting)
+            for lat, lon in ((45.42, -75.7), (49.28, -123.12), (51.05, -114.08)):
+                map_view.center_on(lat, lon)
+                title.schedule(map_view)
+                self.assertIsNotNone(title.pending)
+            for i in range(1000):
+                if title.pending is None and title.waiting is None:
+                    break
+                Gtk.main_iteration_do(True)
+            self.assertLessEqual(len(titles), 3)
+            self.assertEqual(titles[-1], titles[0])
+        finally:
+            geocoder.threaded = False
+    
     def test_navigation_controller(self):
         """Ensure that it's possible to navigate the map."""
         coords = [[
@@ -597,18 +1335,66 @@ S 10.00000, W 10.00000
         get_title = get_obj("main").get_title
         for result in gui.search.results:
             gui.search.search_completed(entry, gui.search.results, result.iter, map_view)
-            loc, lat, lon = result
+            loc, lat, lon, key = result
             self.assertAlmostEqual(lat, map_view.get_property('latitude'), 4)
             self.assertAlmostEqual(lon, map_view.get_property('longitude'), 4)
             
             map_view.emit("animation-completed")
             self.assertEqual(get_title(), "GottenGeography - " + loc)
         
+        # Pressing enter goes back to the last place that was picked.
+        map_view.center_on(0, 0)
+        entry.emit('activate')
+        self.assertAlmostEqual(lat, map_view.get_property('latitude'), 4)
+        self.assertAlmostEqual(lon, map_view.get_property('longitude'), 4)
+        
+        # Only the best matches for what was just typed are loaded, biggest
+        # and closest cities first.
+        map_view.center_on(53.5, -113.5)
         entry.set_text('calg')
-        self.assertEqual(len(gui.search.results), 652)
+        self.assertLessEqual(len(gui.search.results), RESULTS)
+        self.assertEqual(gui.search.results[0][LOCATION],
+                         'Calgary, Alberta, Canada')
+        for result in gui.search.results:
+            self.assertIn('calg', result[KEY])
         
         entry.set_text('st.')
-        self.assertEqual(len(gui.search.results), 671)
+        self.assertEqual(len(gui.search.results), 19)
+        
+        entry.set_text('st')
+        self.assertEqual(len(gui.search.results), 19)
+        
+        # Accents and case don't matter.
+        entry.set_text('MONTRE')
+        self.assertIn('montreal, quebec, canada',
+                      [result[KEY] for result in gui.search.results])
+        self.assertIn('Montr\xc3\xa9al, Quebec, Canada',
+                      [result[LOCATION] for result in gui.search.results])
+    
+    def test_background_search(self):
+        """Make sure searching never makes the user wait to type."""
+        entry = get_obj('search_box')
+        results = gui.search.results
+        results.clear()
+        searcher.threaded = True
+        try:
+            # Only the last of several quick searches is actually made.
+            for text in ('lon', 'lond', 'vic', 'vict'):
+                entry.set_text(text)
+                self.assertEqual(len(results), 0)
+            self.assertIsNotNone(searcher.pending)
+            for i in range(1000):
+                if len(results):
+                    break
+                Gtk.main_iteration_do(True)
+            self.assertGreater(len(results), 0)
+            self.assertLessEqual(len(results), RESULTS)
+            for result in results:
+                self.assertIn('vic', result[KEY])
+        finally:
+            searcher.threaded = False
+            entry.set_text('')
+            results.clear()
     
     def test_preferences(self):
         """Make sure the preferences dialog behaves."""
@@ -0,0 +1,124 @@
+# Copyright (C) 2012 Robert Park <rbpark@exolucere.ca>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Share thumbnails with the rest of the desktop.
+
+The freedesktop.org thumbnail spec keeps thumbnails in ~/.cache/thumbnails,
+in PNG files named after the MD5 of the URI of the file they were made from,
+which also record that URI and the file's modification time. If the file
+has been modified since, the thumbnail is stale and has to be made again.
+
+The file manager has usually thumbnailed photos long before they are opened
+here, so most photos never need to be decoded at all, and the thumbnails
+that are made here are left in the cache for the file manager to use.
+"""
+
+from __future__ import division
+
+from gi.repository import GLib, GObject, GdkPixbuf
+from os.path import join, abspath, dirname
+from os import makedirs, rename, unlink, close, stat
+from tempfile import mkstemp
+from errno import EEXIST
+from hashlib import md5
+
+CACHE = join(GLib.get_user_cache_dir(), 'thumbnails')
+
+# The sizes that thumbnails are cached at, smallest first.
+FLAVOURS = [('normal', 128), ('large', 256),
+            ('x-large', 512), ('xx-large', 1024)]
+
+URI   = 'tEXt::Thumb::URI'
+MTIME = 'tEXt::Thumb::MTime'
+
+def flavour(size):
+    """Return the name and size of the smallest flavour at least that big."""
+    for name, pixels in FLAVOURS:
+        if pixels >= size:
+            return name, pixels
+    return None, None
+
+def scale(pixbuf, size):
+    """Shrink a pixbuf to fit within a square of the given size."""
+    width, height = pixbuf.get_width(), pixbuf.get_height()
+    ratio = size / max(width, height)
+    if ratio >= 1:
+        return pixbuf
+    return pixbuf.scale_simple(max(int(round(width * ratio)), 1),
+                               max(int(round(height * ratio)), 1),
+                               GdkPixbuf.InterpType.BILINEAR)
+
+def save(pixbuf, path, uri, mtime):
+    """Write a thumbnail into the cache.
+    
+    It's written to a temporary file first and then renamed into place, so
+    that nobody ever sees half of it. The cache is only a convenience, so
+    failing to write to it is not an error.
+    """
+    temp = None
+    try:
+        try:
+            makedirs(dirname(path), 0700)
+        except OSError as error:
+            # Another thread may have just made it.
+            if error.errno != EEXIST:
+                raise
+        handle, temp = mkstemp('.png', dir=dirname(path))
+        close(handle)
+        pixbuf.savev(temp, 'png', [URI, MTIME], [uri, mtime])
+        rename(temp, path)
+    except (OSError, GObject.GError):
+        if temp is not None:
+            try:
+                unlink(temp)
+            except OSError:
+                pass
+
+def decode(filename, size, fallback):
+    """Decode a thumbnail from the file, or failing that, from the fallback."""
+    try:
+        return GdkPixbuf.Pixbuf.new_from_file_at_size(filename, size, size)
+    except GObject.GError:
+        return fallback(size)
+
+def thumbnail(filename, size, fallback):
+    """Return a thumbnail of the file that fits within size pixels.
+    
+    On a miss, the file is decoded at the cached size, saved to the cache,
+    and then shrunk down to size. Files that can't be decoded (eg, some raw
+    formats) are given to fallback(size) instead, which may only have a tiny
+    embedded thumbnail to offer, so those aren't cached. Sizes bigger than
+    any cached size are always decoded afresh.
+    """
+    name, pixels = flavour(size)
+    if name is None:
+        return decode(filename, size, fallback)
+    uri = GLib.filename_to_uri(abspath(filename), None)
+    mtime = str(int(stat(filename).st_mtime))
+    path = join(CACHE, name, md5(uri).hexdigest() + '.png')
+    try:
+        cached = GdkPixbuf.Pixbuf.new_from_file(path)
+        if (cached.get_option(MTIME) == mtime and
+            cached.get_option(URI) == uri):
+            return scale(cached, size)
+    except GObject.GError:
+        pass
+    
+    try:
+        made = GdkPixbuf.Pixbuf.new_from_file_at_size(filename, pixels, pixels)
+    except GObject.GError:
+        return fallback(size)
+    save(made, path, uri, mtime)
+    return scale(made, size)
@@ -0,0 +1,228 @@
+# Copyright (C) 2012 Robert Park <rbpark@exolucere.ca>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Convert local times into UTC for any timezone, without touching TZ.
+
+EXIF timestamps are in the local time of wherever the camera happened to be,
+with no indication of which timezone that was. Rather than setting the TZ
+environment variable and calling tzset() and mktime() (which changes the
+timezone of the whole process, one camera at a time), the transition tables
+are read straight out of the system's zoneinfo files, which are in the TZif
+format described in RFC 8536. Each zone is only read once.
+
+Times past the end of a zone's transition table are covered by the POSIX TZ
+rule at the end of the file (eg, 'MST7MDT,M3.2.0,M11.1.0'), which is used
+to extend the table ahead of time so that every lookup is a single bisect.
+"""
+
+from __future__ import division
+
+from calendar import monthrange, isleap
+from datetime import date, timedelta
+from re import compile as re_compile
+from os.path import join, isfile
+from struct import Struct
+from bisect import bisect
+from time import gmtime
+from os import environ
+
+ZONEINFO = environ.get('TZDIR', '/usr/share/zoneinfo')
+LOCALTIME = '/etc/localtime'
+
+HEADER = Struct('>4sc15x6l')
+TTINFO = Struct('>lBB')
+
+DAY = 24 * 60 * 60
+EPOCH = date(1970, 1, 1).toordinal()
+
+# Extend the transition tables this far into the future.
+LAST_YEAR = 2100
+
+POSIX = re_compile(r'(<[^>]*>|[A-Za-z]+)([+-]?[\d:]+)'
+                   r'(?:(<[^>]*>|[A-Za-z]+)([+-]?[\d:]+)?,([^,]+),([^,]+))?$')
+
+known_zones = {}
+
+def get_zone(name):
+    """Return the TimeZone with the given name, loading it only once.
+    
+    An empty name means the system timezone.
+    """
+    if name not in known_zones:
+        known_zones[name] = TimeZone(name)
+    return known_zones[name]
+
+def seconds(text):
+    """Convert a POSIX TZ time like '-3:30' into seconds."""
+    sign = -1 if text.startswith('-') else 1
+    parts = [int(part) for part in text.lstrip('+-').split(':')]
+    return sign * sum(part * 60 ** (2 - i) for i, part in enumerate(parts))
+
+def rule_time(rule, year):
+    """Return when a POSIX TZ rule takes effect, in seconds of local time.
+    
+    Rules are one of Mm.w.d (day d of week w of month m, where week 5 means
+    the last one and day 0 is Sunday), Jn (day n of the year, from 1, never
+    counting February 29th), or n (day n of the year, from 0), optionally
+    followed by /time, which is 2am if not given.
+    """
+    day, slash, time = rule.partition('/')
+    if day.startswith('M'):
+        month, week, weekday = [int(part) for part in day[1:].split('.')]
+        first = date(year, month, 1).weekday() + 1
+        mday = 1 + (weekday - first) % 7 + 7 * (week - 1)
+        while mday > monthrange(year, month)[1]:
+            mday -= 7
+        when = date(year, month, mday)
+    elif day.startswith('J'):
+        yday = int(day[1:])
+        when = date(year, 1, 1) + timedelta(
+            yday - 1 + (isleap(year) and yday >= 60))
+    else:
+        when = date(year, 1, 1) + timedelta(int(day))
+    return (when.toordinal() - EPOCH) * DAY + (seconds(time) if time else 7200)
+
+
+class TimeZone():
+    """The history of a single timezone's offsets from UTC.
+    
+    The starts list holds the UTC time at which each offset came into
+    effect, beginning with negative infinity for the offset in effect before
+    anything was recorded, and the daylight list says which of them were
+    daylight saving time. Unknown zones are treated as UTC, same as glibc.
+    """
+    
+    def __init__(self, name):
+        self.name    = name
+        self.starts  = [float('-inf')]
+        self.offsets = [0]
+        self.daylight = [False]
+        
+        filename = self.find(name)
+        if filename is not None:
+            try:
+                with open(filename, 'rb') as tzfile:
+                    self.load(tzfile.read())
+                return
+            except (IOError, ValueError):
+                self.starts, self.offsets, self.daylight = \
+                    [float('-inf')], [0], [False]
+        self.extend(name)
+    
+    def find(self, name):
+        """Find the zoneinfo file for the given zone name."""
+        if not name:
+            name = environ.get('TZ', '').lstrip(':') or LOCALTIME
+        filename = join(ZONEINFO, name)
+        return filename if isfile(filename) else None
+    
+    def load(self, data):
+        """Read the transition table out of a TZif file."""
+        magic, version, isutcnt, isstdcnt, leapcnt, timecnt, typecnt, charcnt \
+            = HEADER.unpack_from(data)
+        if magic != 'TZif':
+            raise ValueError('%s is not a zoneinfo file.' % self.name)
+        size, position = 4, HEADER.size
+        if version >= '2':
+            # Skip the 32 bit data in favour of the 64 bit data after it.
+            position += (timecnt * 5 + typecnt * 6 + charcnt + leapcnt * 8 +
+                         isstdcnt + isutcnt)
+            magic, version, isutcnt, isstdcnt, leapcnt, timecnt, typecnt, \
+                charcnt = HEADER.unpack_from(data, position)
+            size, position = 8, position + HEADER.size
+        
+        times = Struct('>%d%s' % (timecnt, 'q' if size == 8 else 'l'))
+        indices = Struct('>%dB' % timecnt)
+        types = [TTINFO.unpack_from(data, position + timecnt * (size + 1) +
+                                    TTINFO.size * i) for i in xrange(typecnt)]
+        
+        # Before the first transition, the first type is in effect.
+        found = [types[0]] + [types[i] for i in
+            indices.unpack_from(data, position + timecnt * size)]
+        self.offsets  = [offset for offset, isdst, name in found]
+        self.daylight = [bool(isdst) for offset, isdst, name in found]
+        self.starts  += times.unpack_from(data, position)
+        
+        position += (timecnt * (size + 1) + typecnt * TTINFO.size + charcnt +
+                     leapcnt * (size + 4) + isstdcnt + isutcnt)
+        if size == 8:
+            self.extend(data[position:].strip('\n'))
+    
+    def extend(self, rule):
+        """Add the transitions of a POSIX TZ rule up until LAST_YEAR."""
+        match = POSIX.match(rule)
+        if match is None:
+            return
+        stdoff, dst, dstoff, start, end = match.groups()[1:]
+        std = -seconds(stdoff)
+        if len(self.starts) == 1:
+            # There's no table, just this rule (eg, TZ='EST5EDT').
+            self.offsets = [std]
+        if dst is None:
+            return
+        dst = -seconds(dstoff) if dstoff else std + 3600
+        first = gmtime(max(self.starts[-1], 0)).tm_year
+        for year in xrange(first, LAST_YEAR + 1):
+            for when, offset, daylight in sorted([
+                    (rule_time(start, year) - std, dst, True),
+                    (rule_time(end, year) - dst, std, False)]):
+                if when > self.starts[-1]:
+                    self.starts.append(when)
+                    self.offsets.append(offset)
+                    self.daylight.append(daylight)
+    
+    def offset(self, utc):
+        """Return the offset from UTC that was in effect at the given time."""
+        return self.offsets[bisect(self.starts, utc) - 1]
+    
+    def to_utc(self, local):
+        """Convert seconds of local time since the epoch into UTC.
+        
+        When clocks go back, the times that happen twice are taken to be
+        the first of the two, because mktime() can't be relied upon to pick
+        either one consistently. When clocks go forward, the times that are
+        skipped are taken to be in standard time, so 2:30am becomes 3:30am
+        daylight time, the same as mktime().
+        """
+        before = self.offset(local - DAY)
+        for offset in (before, self.offset(local + DAY)):
+            if self.offset(local - offset) == offset:
+                return local - offset
+        n = bisect(self.starts, local - before) - 1
+        return local - (before if self.daylight[n] else self.offsets[n])
+    
+    def to_utc_many(self, times):
+        """Convert many local times into UTC at once.
+        
+        The times are visited in order, and while they stay within a stretch
+        of local time that isn't near any transition, each one is converted
+        with a single subtraction, so converting a whole camera's worth of
+        photos is hardly more expensive than converting one.
+        """
+        results = [None] * len(times)
+        low, high, offset = 0, 0, 0
+        last = len(self.starts) - 1
+        for i in sorted(xrange(len(times)), key=times.__getitem__):
+            local = times[i]
+            if low <= local < high:
+                results[i] = local - offset
+                continue
+            results[i] = self.to_utc(local)
+            n = bisect(self.starts, results[i]) - 1
+            offset = self.offsets[n]
+            low = self.starts[n] + max(offset, self.offsets[max(n - 1, 0)])
+            high = (self.starts[n + 1] + min(offset, self.offsets[n + 1])
+                    if n < last else float('inf'))
+        return results
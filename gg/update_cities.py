@@ -1,14 +1,135 @@
 #!/usr/bin/python
 
-# This takes the cities1000.txt file from geonames.org and extracts just the
-# data we need for the cities.txt file. It's important to strip out the less
-# useful data because the file is truly prodigous in size.
+# This takes a dump from geonames.org (eg, allCountries.txt or cities1000.txt)
+# and builds the cities.db database that GottenGeography searches. The dump
+# is truly prodigious in size, so it's split into chunks which are streamed
+# and filtered by several processes at once, and only the places worth
+# keeping are ever held in memory.
 
 # Usage:
-# ./update_cities.py cities1000.txt > cities.txt
+# ./update_cities.py allCountries.txt ../data/cities.db
+# ./update_cities.py --population 5000 --classes PA cities1000.txt cities.db
 
-from fileinput import input
+from multiprocessing import Pool, cpu_count
+from argparse import ArgumentParser
+from os.path import getsize
 
-for line in input():
-    col = line.split('\t')
-    print '\t'.join([col[1], col[4], col[5], col[8], col[10], col[17]])
+from cities import write_database
+
+# How many bytes of the dump each process reads at a time.
+CHUNK_SIZE = 32 * 1024 * 1024
+
+# Places with the same name in the same country that are within this many
+# degrees of each other are considered to be the same place.
+SAME_PLACE = 0.1
+
+# Where to look for duplicates, starting with a place's own cell.
+NEIGHBOURS = [(0, 0)] + [(dy, dx) for dy in (-1, 0, 1) for dx in (-1, 0, 1)
+                         if dy or dx]
+
+def chunks(filename, size=CHUNK_SIZE):
+    """Divide a file into (start, end) byte ranges."""
+    total = getsize(filename)
+    return [(start, min(start + size, total)) for start in xrange(0, total, size)]
+
+def read_chunk(filename, start, end):
+    """Generate the lines that begin within the given byte range.
+    
+    A line that straddles the end of the range belongs to this chunk, and
+    so the partial line at the start of the range is skipped.
+    """
+    with open(filename) as dump:
+        if start > 0:
+            dump.seek(start - 1)
+            dump.readline()
+        position = dump.tell()
+        while position < end:
+            line = dump.readline()
+            if not line:
+                break
+            position += len(line)
+            yield line
+
+def parse_chunk(task):
+    """Extract the places that are worth keeping from one chunk of the dump.
+    
+    Returns a list of (lat, lon, name, state, country, tz, population,
+    alternate names) tuples, ready for cities.write_database.
+    """
+    filename, start, end, population, classes = task
+    classes = set(classes)
+    places = []
+    for line in read_chunk(filename, start, end):
+        col = line.rstrip('\n').split('\t')
+        if len(col) < 18 or col[6] not in classes:
+            continue
+        try:
+            people = int(col[14] or 0)
+            lat, lon = float(col[4]), float(col[5])
+        except ValueError:
+            continue
+        if people < population:
+            continue
+        alternates = ','.join(sorted(set(
+            [name for name in col[3].split(',') if name and name != col[1]])))
+        places.append((lat, lon, col[1], col[10], col[8], col[17],
+                       people, alternates))
+    return places
+
+def same_place(place):
+    """Sort places into cells of SAME_PLACE degrees by name and country."""
+    lat, lon, name, state, country = place[0:5]
+    return (name.lower(), country,
+            int(round(lat / SAME_PLACE)), int(round(lon / SAME_PLACE)))
+
+def keep(kept, place):
+    """Add a place to the dict of kept places, unless it's a duplicate.
+    
+    Duplicates can be on either side of the edge of a cell, so the cells
+    around the place are checked too. Of duplicate places, the most
+    populous one is kept.
+    """
+    key = same_place(place)
+    name, country, y, x = key
+    for dy, dx in NEIGHBOURS:
+        other = (name, country, y + dy, x + dx)
+        found = kept.get(other)
+        if found is None or not (abs(found[0] - place[0]) <= SAME_PLACE and
+                                 abs(found[1] - place[1]) <= SAME_PLACE):
+            continue
+        if (place[6], place) > (found[6], found):
+            del kept[other]
+            kept[key] = place
+        return
+    kept[key] = place
+
+def build(dump, output, population=1000, classes='P', jobs=None):
+    """Build cities.db from a dump, and return how many places it has."""
+    tasks = [(dump, start, end, population, classes)
+             for start, end in chunks(dump)]
+    kept = {}
+    for places in Pool(jobs or cpu_count()).imap_unordered(parse_chunk, tasks):
+        for place in places:
+            keep(kept, place)
+    write_database(kept.values(), output)
+    return len(kept)
+
+def main():
+    """Build cities.db from the dump named on the command line."""
+    parser = ArgumentParser(description='Build cities.db from geonames.org.')
+    parser.add_argument('dump', help='geonames.org dump, eg allCountries.txt')
+    parser.add_argument('output', help='where to write cities.db')
+    parser.add_argument('--population', type=int, default=1000,
+                        help='leave out places with fewer people than this')
+    parser.add_argument('--classes', default='P',
+                        help='geonames feature classes to keep, eg PA')
+    parser.add_argument('--jobs', type=int, default=cpu_count(),
+                        help='how many processes to use')
+    args = parser.parse_args()
+    
+    count = build(args.dump, args.output, args.population, args.classes,
+                  args.jobs)
+    print '%d places written to %s.' % (count, args.output)
+
+if __name__ == '__main__':
+    main()
@@ -22,13 +22,20 @@ from dateutil.parser import parse as parse_date
 from gi.repository import Champlain, Clutter
 from gi.repository import Gtk, Gdk, GLib
 from re import compile as re_compile
+from gettext import gettext as _
+from itertools import izip, imap
+from bisect import bisect, bisect_left
+from heapq import merge
 from os.path import basename
 from calendar import timegm
 from time import clock
 
 from gpsmath import Coordinates
+from segment import Segment
+from grid import GridIndex
+from fusion import fuse, dilution
 from common import GSettings, Builder, gst, get_obj
-from common import map_view, points, metadata
+from common import map_view, points, metadata, dem, retag_photos
 
 BOTTOM = Gtk.PositionType.BOTTOM
 RIGHT = Gtk.PositionType.RIGHT
@@ -41,10 +48,28 @@ def get_trackfile(uri):
     """This method caches TrackFile instances."""
     if uri not in known_trackfiles:
         fmt = KMLFile if uri[-3:].lower() == 'kml' else GPXFile
-        known_trackfiles[uri] = fmt(uri)
+        trackfile = known_trackfiles[uri] = fmt(uri)
+        refresh_points(trackfile.alpha, trackfile.omega)
+        retag_photos(trackfile.alpha, trackfile.omega)
     
     return known_trackfiles[uri]
 
+def refresh_points(start, end):
+    """Fuse the points of every loaded track file from start to end.
+    
+    Where several devices were logging at the same time, only the points
+    from the best of them are kept, so photos don't jump between devices.
+    Loading or unloading a track file can only change which points are kept
+    during that file's own span of time, so only that span is fused again.
+    """
+    points.replace(start, end, [(stamp, point) for stamp, point in
+        fuse([(trackfile.gst.get_int('priority'),
+               trackfile.timeline(start, end))
+              for trackfile in known_trackfiles.values()])
+        if start <= stamp <= end])
+    metadata.alpha = points.stamps[0]  if points else float('inf')
+    metadata.omega = points.stamps[-1] if points else float('-inf')
+
 def make_clutter_color(color):
     """Generate a Clutter.Color from the currently chosen color."""
     return Clutter.Color.new(
@@ -60,6 +85,17 @@ def track_color_changed(selection, polys):
     for i, polygon in enumerate(polys):
         polygon.set_stroke_color(two if i % 2 else one)
 
+def nearest_point(lat, lon, within=None):
+    """Find the track point nearest to the given location, in any track file.
+    
+    Returns a tuple of (distance in km, timestamp), or None if there are
+    no track points within the given number of kilometres.
+    """
+    found = [trackfile.nearest(lat, lon, within)
+             for trackfile in known_trackfiles.values()]
+    found = [result for result in found if result is not None]
+    return min(found) if found else None
+
 def clear_all_gpx(widget=None):
     """Forget all GPX data, start over with a clean slate."""
     for trackfile in known_trackfiles.values():
@@ -167,16 +203,36 @@ class TrackFile(Coordinates):
         self.filename = filename
         self.progress = get_obj('progressbar')
         self.clock    = clock()
-        self.append   = None
+        self.index    = None
+        self.segment  = None
+        self.segments = []
         self.tracks   = {}
         self.polygons = set()
+        self.outliers = 0
+        self.drawn    = []
+        self.smoothed = False
         
         self.parser = XMLSimpleParser(root, watch)
         self.parser.parse(filename, self.element_start, self.element_end)
         
+        for segment in self.segments:
+            if gst.get_boolean('filter-outliers'):
+                self.outliers += segment.filter_outliers()
+            segment.fill_elevations(dem)
+            self.draw(segment)
+        
+        # Keep the segments in chronological order so that they can be
+        # searched by time, and measure them in that order.
+        self.segments = sorted([segment for segment in self.segments
+                                if len(segment) > 0],
+                               key=lambda segment: segment.times[0])
+        self.starts = [segment.times[0] for segment in self.segments]
+        if gst.get_boolean('smooth-tracks'):
+            self.smooth()
+        self.measure()
+        
         empty_trackfile_label.hide()
         
-        points.update(self.tracks)
         keys = self.tracks.keys()
         self.alpha = min(keys)
         self.omega = max(keys)
@@ -189,8 +245,10 @@ class TrackFile(Coordinates):
         self.colorpicker = builder.get_object('colorpicker')
         self.trash = builder.get_object('unload')
         self.label = builder.get_object('trackfile_label')
+        self.stats = builder.get_object('trackfile_stats')
         
         self.label.set_text(basename(filename))
+        self.stats.set_text(self.pretty_statistics())
         self.colorpicker.set_title(basename(filename))
         self.colorpicker.connect('color-set', track_color_changed, self.polygons)
         self.trash.connect('clicked', self.destroy)
@@ -210,11 +268,131 @@ class TrackFile(Coordinates):
         self.gst.bind_with_convert('track-color', self.colorpicker, 'color',
             lambda x: Gdk.Color(*x), lambda x: (x.red, x.green, x.blue))
         self.colorpicker.emit('color-set')
+        
+        # Smoothing is slow, so it waits until somebody wants it. Cameras
+        # connect after this, so the tracks are smoothed before the photos
+        # are moved onto them, see Camera.__init__.
+        self.smoothing = gst.connect('changed::smooth-tracks',
+                                     self.smooth_handler)
+    
+    def smooth_handler(self, gst, key):
+        """Measure the tracks again whenever smoothing is toggled.
+        
+        The tracks are smoothed the first time that smoothing is turned on.
+        """
+        if gst.get_boolean(key) and not self.smoothed:
+            self.smooth()
+        self.measure()
+        self.stats.set_text(self.pretty_statistics())
+    
+    def smooth(self):
+        """Calculate the smoothed coordinates of every point."""
+        self.smoothed = True
+        for segment, coords in self.drawn:
+            segment.smooth()
+            for coord, smooth in izip(coords,
+                    izip(segment.smooth_lats, segment.smooth_lons)):
+                coord.smooth = smooth
+    
+    def measure(self):
+        """Total up the distance, climb, and speeds of all the segments.
+        
+        The smoothed tracks are measured if smoothing is turned on, because
+        GPS noise adds a lot of imaginary distance.
+        """
+        smooth = self.smoothed and gst.get_boolean('smooth-tracks')
+        self.distance = self.climb = 0.0
+        for segment in self.segments:
+            self.distance, self.climb = segment.measure(
+                self.distance, self.climb, smooth)
+        self.moving_time = sum([seg.moving_time for seg in self.segments])
+        self.max_speed   = max([seg.max_speed   for seg in self.segments] or [0])
     
     def element_start(self, name, attributes):
         """Placeholder for a method that gets overridden in subclasses."""
         return False
     
+    def segment_at(self, timestamp):
+        """Find the segment that was being recorded at the given moment.
+        
+        Moments between segments belong to the earlier segment, and moments
+        outside of the track belong to the nearest end of it.
+        """
+        return self.segments[max(bisect(self.starts, timestamp) - 1, 0)]
+    
+    def distance_between(self, start, end):
+        """Return the distance in metres travelled between two moments."""
+        return abs(self.segment_at(end).distance_at(end) -
+                   self.segment_at(start).distance_at(start))
+    
+    def speed_at(self, timestamp):
+        """Return the speed in m/s at the given moment."""
+        return self.segment_at(timestamp).speed_at(timestamp)
+    
+    def timeline(self, start=float('-inf'), end=float('inf')):
+        """Generate (timestamp, dop, coordinate) for the points, in order.
+        
+        Only the points from start to end are generated, plus the points on
+        either side of them, so that fuse() knows whether this device was
+        logging at the start and end. Segments are sorted by when they
+        started, but may still overlap, so they are merged lazily rather
+        than concatenated.
+        """
+        spans = []
+        for segment in self.segments:
+            lo = max(bisect_left(segment.times, start) - 1, 0)
+            hi = bisect(segment.times, end) + 1
+            times = segment.times[lo:hi]
+            spans.append(izip(times, segment.dops[lo:hi],
+                              imap(self.tracks.get, times)))
+        return merge(*spans)
+    
+    def nearest(self, lat, lon, within=None):
+        """Find the point nearest to the given location, and when it was.
+        
+        The spatial index is built the first time it is needed, because most
+        track files will never be asked.
+        """
+        if self.index is None:
+            self.index = GridIndex()
+            for segment in self.segments:
+                for timestamp, lat2, lon2, ele in segment:
+                    self.index.add(lat2, lon2, timestamp)
+        return self.index.nearest(lat, lon, within)
+    
+    def pretty_statistics(self):
+        """Summarize how far, how long, and how fast this track went."""
+        duration = lambda seconds: '%d:%02d:%02d' % (
+            seconds // 3600, seconds % 3600 // 60, seconds % 60)
+        return '\n'.join([
+            _('%.2fkm in %s (%s moving)') % (self.distance / 1000,
+                duration(self.omega - self.alpha), duration(self.moving_time)),
+            _('Top speed %.1fkm/h, climbed %dm') % (self.max_speed * 3.6,
+                self.climb)])
+    
+    def new_segment(self):
+        """Start collecting points into a new track segment."""
+        self.segment = Segment()
+        self.segments.append(self.segment)
+    
+    def draw(self, segment):
+        """Put a segment onto the map, and index its points by timestamp.
+        
+        The raw coordinates are drawn, but once the track is smoothed, each
+        point also carries its smoothed coordinates, see smooth().
+        """
+        if len(segment) == 0:
+            return
+        polygon = Polygon()
+        map_view.add_layer(polygon)
+        self.polygons.add(polygon)
+        coords = []
+        for timestamp, lat, lon, ele in segment:
+            coord = polygon.append_point(lat, lon, ele)
+            coords.append(coord)
+            self.tracks[timestamp] = coord
+        self.drawn.append((segment, coords))
+    
     def element_end(self, name, state):
         """Occasionally redraw the screen so the user can see what's happening."""
         if clock() - self.clock > .2:
@@ -225,14 +403,15 @@ class TrackFile(Coordinates):
     
     def destroy(self, button=None):
         """Die a horrible death."""
+        gst.disconnect(self.smoothing)
         for polygon in self.polygons:
             map_view.remove_layer(polygon)
-        for timestamp in self.tracks:
-            del points[timestamp]
         self.polygons.clear()
-        for widget in (self.label, self.colorpicker, self.trash):
+        for widget in (self.label, self.stats, self.colorpicker, self.trash):
             widget.destroy()
         del known_trackfiles[self.filename]
+        refresh_points(self.alpha, self.omega)
+        retag_photos(self.alpha, self.omega)
         if not known_trackfiles:
             empty_trackfile_label.show()
 
@@ -251,10 +430,7 @@ class GPXFile(TrackFile):
     def element_start(self, name, attributes):
         """Adds a new polygon for each new segment, and watches for track points."""
         if name == 'trkseg':
-            polygon = Polygon()
-            map_view.add_layer(polygon)
-            self.polygons.add(polygon)
-            self.append = polygon.append_point
+            self.new_segment()
         if name == 'trkpt':
             return True
         return False
@@ -263,8 +439,7 @@ class GPXFile(TrackFile):
         """Collect and use all the parsed data.
         
         This method does most of the heavy lifting, including parsing time
-        strings into UTC epoch seconds, appending to the ChamplainMarkerLayers,
-        keeping track of the first and last points loaded.
+        strings into UTC epoch seconds, and appending to the current segment.
         """
         # We only care about the trkpt element closing, because that means
         # there is a new, fully-loaded GPX point to play with.
@@ -280,7 +455,9 @@ class GPXFile(TrackFile):
             # Better to just give up on this track point and go to the next.
             return
         
-        self.tracks[timestamp] = self.append(lat, lon, float(state.get('ele', 0.0)))
+        self.segment.append(timestamp, lat, lon,
+            float(state['ele']) if 'ele' in state else None,
+            dilution(state.get('hdop'), state.get('sat')))
         
         TrackFile.element_end(self, name, state)
 
@@ -298,10 +475,7 @@ class KMLFile(TrackFile):
     def element_start(self, name, attributes):
         """Adds a new polygon for each new gx:Track, and watches for location data."""
         if name == 'gx:Track':
-            polygon = Polygon()
-            map_view.add_layer(polygon)
-            self.polygons.add(polygon)
-            self.append = polygon.append_point
+            self.new_segment()
             return False
         return True
     
@@ -323,10 +497,10 @@ class KMLFile(TrackFile):
         complete = min(len(self.whens), len(self.coords))
         if complete > 0:
             for i in range(0, complete):
-                self.tracks[self.whens[i]] = \
-                    self.append(float(self.coords[i][1]), \
-                                float(self.coords[i][0]), \
-                                float(self.coords[i][2]))
+                self.segment.append(self.whens[i],
+                                    float(self.coords[i][1]),
+                                    float(self.coords[i][0]),
+                                    float(self.coords[i][2]))
             self.whens = self.whens[complete:]
             self.coords = self.coords[complete:]
         
@@ -2,8 +2,8 @@
 
 from glob import glob
 from os import listdir
-from os.path import join
-from distutils.core import setup
+from os.path import join, exists, getmtime
+from distutils.core import setup, Command
 from subprocess import Popen, PIPE
 from DistUtilsExtra.command import *
 from distutils.command.build_py import build_py as _build_py
@@ -15,7 +15,7 @@ data_files = [
     ('share/glib-2.0/schemas', ['data/ca.exolucere.%s.gschema.xml' % PACKAGE]),
     ('share/applications', ['data/%s.desktop' % PACKAGE]),
     ('share/doc/' + PACKAGE, ['README.md', 'AUTHORS', 'COPYING']),
-    ('share/' + PACKAGE, ['data/cities.txt', 'data/trackfile.ui', 'data/camera.ui',
+    ('share/' + PACKAGE, ['data/cities.db', 'data/trackfile.ui', 'data/camera.ui',
         'data/%s.ui' % PACKAGE, 'data/%s.svg' % PACKAGE])
 ]
 
@@ -52,6 +52,40 @@ class build_py(_build_py):
         
         _build_py.build_module(self, module, module_file, package)
 
+class build_cities(Command):
+    """Build the binary data/cities.db.
+    
+    It's built from a geonames.org dump (eg, cities1000.txt) if there is one,
+    because only the dump has the populations that search results are ranked
+    by. Otherwise it's converted from data/cities.txt.
+    """
+    description = 'build the binary cities database'
+    user_options = [('dump=', None,
+                     'geonames.org dump [default: data/cities1000.txt]')]
+    
+    def initialize_options(self):
+        self.dump = None
+    
+    def finalize_options(self):
+        if self.dump is None and exists('data/cities1000.txt'):
+            self.dump = 'data/cities1000.txt'
+    
+    def run(self):
+        source, destination = self.dump or 'data/cities.txt', 'data/cities.db'
+        if exists(source) and (not exists(destination) or
+                getmtime(destination) < getmtime(source)):
+            self.announce('building %s from %s' % (destination, source), 2)
+            if self.dump is not None:
+                from gg.update_cities import build
+                build(source, destination)
+            else:
+                from gg.cities import build_database
+                build_database(source, destination)
+
+class build(build_extra.build_extra):
+    """Build the cities database before anything else."""
+    sub_commands = [('build_cities', None)] + build_extra.build_extra.sub_commands
+
 setup(
     name=PACKAGE,
     version=VERSION,
@@ -72,7 +106,8 @@ and then record those locations into the photos.
     packages=['gg'],
     scripts=['gottengeography'],
     data_files=data_files,
-    cmdclass = { "build" : build_extra.build_extra,
+    cmdclass = { "build" : build,
+                 "build_cities" : build_cities,
                  "build_i18n" :  build_i18n.build_i18n,
                  "build_py": build_py }
 )
@@ -1,3 +1,4 @@
 #!/bin/bash
 
+python2.7 setup.py -q build_cities
 python2.7 gg/testsuite.py